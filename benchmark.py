@@ -0,0 +1,244 @@
+'''
+Headless benchmarks of the settlement generator on synthetic worlds.
+
+Run from a directory where pymclevel is importable (e.g. MCEdit's 'stock-filters'), e.g.
+    python benchmark.py --worlds plains hills --sizes 64 256 --output bench.json
+and compare two result files with
+    python benchmark.py --compare before.json after.json
+'''
+import argparse
+import json
+import multiprocessing
+import platform
+import random
+import sys
+import time
+from collections import defaultdict
+
+import numpy as np
+from pymclevel import BoundingBox
+
+from myglobals import *
+from level_extensions import inject as LVinject
+from buildsite import Site, splitIntoPlots, fillInPlotNeighbours
+from construction import builderCollective, clearAboveSurface
+from staging import StagingLevel
+
+########################################################################
+# synthetic worlds
+########################################################################
+
+# baseHeight, amplitude, waterLevel, treeDensity, biome
+WORLD_TYPES = {
+    'plains' : (64,  4, None, .0,    1), # Plains
+    'hills'  : (64, 30, None, .002,  3), # Extreme Hills
+    'water'  : (58, 12,   62, .0,    0), # Ocean
+    'forest' : (64,  8, None, .03,   4), # Forest
+}
+
+# 1024 takes a while and needs a few GB of memory
+SIZES = 64, 128, 256, 512, 1024
+
+SITE_MIN_Y = 40
+SITE_HEIGHT = 80
+
+def smoothNoise(rng, size, scale, octaves=3):
+    "Value noise in [0, 1]: random grids of increasing resolution, bilinearly upsampled and summed"
+    result = np.zeros((size, size))
+    amplitude = 1.
+    total = 0.
+    for octave in range(octaves):
+        cells = max( 2, size * 2**octave // scale + 2 )
+        grid = rng.random_sample((cells, cells))
+        coords = np.linspace(0, cells-1, size)
+        i0 = np.floor(coords).astype(int)
+        i1 = np.minimum(i0 + 1, cells - 1)
+        f = coords - i0
+        rows = grid[i0] * (1-f)[:, np.newaxis] + grid[i1] * f[:, np.newaxis]
+        result += amplitude * ( rows[:, i0] * (1-f) + rows[:, i1] * f )
+        total += amplitude
+        amplitude /= 2
+    return result / total
+
+def createWorld(worldType, size, seed):
+    "Create an in-memory world of size x size blocks (rounded up to chunks) starting at the origin, with terrain of the given type"
+    baseHeight, amplitude, waterLevel, treeDensity, biome = WORLD_TYPES[worldType]
+    rng = np.random.RandomState(seed)
+    chunkCount = (size + 15) // 16
+    heights = ( baseHeight + amplitude * (smoothNoise(rng, chunkCount * 16, 64) - .5) ).astype(int)
+    trees = rng.random_sample(heights.shape) < treeDensity
+
+    level = StagingLevel()
+    for cx in range(chunkCount):
+        for cz in range(chunkCount):
+            chunk = level.createChunk(cx, cz)
+            tile = heights[cx*16 : cx*16+16, cz*16 : cz*16+16] # indexed [x, z]
+            ys = np.arange(level.Height)
+            below = ys < tile[..., np.newaxis]
+            chunk.Blocks[:] = materials.Air.ID
+            chunk.Blocks[ below ] = materials.Stone.ID
+            chunk.Blocks[ below & (ys >= tile[..., np.newaxis] - 3) ] = materials.Dirt.ID
+            chunk.Blocks[ ys == tile[..., np.newaxis] ] = materials.Grass.ID
+            chunk.Data[:] = 0
+            if waterLevel is not None:
+                flooded = (ys > tile[..., np.newaxis]) & (ys <= waterLevel)
+                chunk.Blocks[ flooded ] = materials.Water.ID
+                chunk.Blocks[ (ys == tile[..., np.newaxis]) & (tile[..., np.newaxis] < waterLevel) ] = materials.Sand.ID
+            # trees stay inside their chunk, so the crown needs no bookkeeping across chunk borders
+            for x, z in zip( *np.nonzero(trees[cx*16 : cx*16+16, cz*16 : cz*16+16]) ):
+                if not (0 < x < 15 and 0 < z < 15):
+                    continue
+                y = tile[x, z]
+                chunk.Blocks[x-1:x+2, z-1:z+2, y+4:y+6] = materials.Leaves.ID
+                chunk.Blocks[x, z, y+1:y+5] = materials.Wood.ID
+            chunk.Biomes[:] = biome
+    return level, BoundingBox( (0, SITE_MIN_Y, 0), (size, SITE_HEIGHT, size) )
+
+########################################################################
+# stages
+########################################################################
+
+def peakMemory():
+    "Peak resident memory of this process in KB; None where the resource module isn't available"
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak # bytes on OS X, KB on Linux
+
+class StageTimer:
+
+    def __init__(self):
+        self.stages = []
+
+    def run(self, name, func, *args, **kwargs):
+        tstart = time.time()
+        result = func(*args, **kwargs)
+        self.stages.append( { 'stage' : name, 'seconds' : time.time() - tstart, 'peakMemoryKB' : peakMemory() } )
+        return result
+
+def benchmarkStages(worldType, size, seed):
+    "Time the generator stage by stage on a fresh synthetic world"
+    random.seed(seed)
+    np.random.seed(seed)
+    level, box = createWorld(worldType, size, seed)
+    LVinject(level, bufferWrites=True)
+    timer = StageTimer()
+
+    site = timer.run( 'siteAnalysis', Site, level, box, registrar=lambda site: [] )
+    site.plots = timer.run( 'splitIntoPlots', splitIntoPlots, site )
+    timer.run( 'neighbours', fillInPlotNeighbours, site.plots )
+    site.indexPlots()
+
+    timer.run( 'clearAboveSurface', clearAboveSurface, site, site.bounds.expand(2, 10, 2) )
+    timer.run( 'bidding', builderCollective().awardPlots, site.plots )
+
+    plotsByBuilder = defaultdict(list)
+    for plot in site.plots:
+        if hasattr(plot, 'builder'):
+            plotsByBuilder[plot.builder.name].append(plot)
+    for name, plots in sorted( plotsByBuilder.items() ):
+        timer.run( 'build:' + name, lambda: [ plot.builder.build(plot) for plot in plots ] )
+
+    timer.run( 'flushWrites', level.flushWrites )
+    return timer.stages
+
+def benchmarkPerform(worldType, size, seed):
+    "Time the whole filter on a fresh synthetic world"
+    import gdmc
+    random.seed(seed)
+    np.random.seed(seed)
+    level, box = createWorld(worldType, size, seed)
+    options = {
+        gdmc.P_SEASON : 'summer',
+        gdmc.P_OVERRIDE_SIZE : False,
+        gdmc.P_WIDTH : size,
+        gdmc.P_LENGTH : size,
+        gdmc.P_HEIGHT : SITE_HEIGHT,
+        gdmc.P_PROCESSES : 1,
+        gdmc.P_STAGING : False,
+        gdmc.P_VERBOSITY : 'quiet',
+        gdmc.P_REPORT : '',
+        gdmc.P_CACHE : '',
+        gdmc.P_TILE_SIZE : 0,
+    }
+    timer = StageTimer()
+    timer.run( 'perform', gdmc.perform, level, box, options )
+    return timer.stages
+
+def runIsolated(func, *args):
+    "Run func in its own worker process, so one case's memory peak doesn't carry over to the next"
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(func, args)
+    finally:
+        pool.close()
+        pool.join()
+
+########################################################################
+
+def canPerform():
+    "Whether the filter module imports outside MCEdit, so the whole filter can be timed"
+    try:
+        import gdmc
+    except ImportError as error:
+        print 'skipping perform:', error
+        return False
+    return True
+
+def runBenchmarks(worldTypes, sizes, seeds, withPerform=True):
+    withPerform = withPerform and canPerform()
+    results = []
+    for worldType in worldTypes:
+        for size in sizes:
+            for seed in seeds:
+                case = { 'world' : worldType, 'size' : size, 'seed' : seed }
+                print 'benchmarking', case
+                case['stages'] = runIsolated(benchmarkStages, worldType, size, seed)
+                if withPerform:
+                    case['stages'] += runIsolated(benchmarkPerform, worldType, size, seed)
+                results.append(case)
+    return {
+        'created' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python'  : platform.python_version(),
+        'numpy'   : np.__version__,
+        'machine' : platform.platform(),
+        'cpus'    : multiprocessing.cpu_count(),
+        'results' : results,
+    }
+
+def compareResults(before, after):
+    "Print the timings of two result files side by side, matched by world, size, seed and stage"
+    def timings(report):
+        return dict( ( (case['world'], case['size'], case['seed'], stage['stage']), stage['seconds'] )
+                        for case in report['results'] for stage in case['stages'] )
+    old = timings(before)
+    new = timings(after)
+    print '%-8s %5s %6s %-24s %10s %10s %8s' % ('world', 'size', 'seed', 'stage', 'before', 'after', 'speedup')
+    for key in sorted( set(old) & set(new) ):
+        speedup = old[key] / new[key] if new[key] else float('inf')
+        print '%-8s %5d %6d %-24s %10.3f %10.3f %7.2fx' % ( key + (old[key], new[key], speedup) )
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--worlds', nargs='+', choices=sorted(WORLD_TYPES), default=sorted(WORLD_TYPES))
+    parser.add_argument('--sizes', nargs='+', type=int, choices=SIZES, default=[64, 128, 256])
+    parser.add_argument('--seeds', nargs='+', type=int, default=[0])
+    parser.add_argument('--no-perform', dest='withPerform', action='store_false', help="skip timing the whole filter")
+    parser.add_argument('--output', default='bench_output.json')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help="compare two result files instead of running")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as before, open(args.compare[1]) as after:
+            compareResults( json.load(before), json.load(after) )
+        return
+
+    report = runBenchmarks(args.worlds, args.sizes, args.seeds, args.withPerform)
+    with open(args.output, 'w') as out:
+        json.dump(report, out, indent=2, sort_keys=True)
+    print 'results written to', args.output
+
+if __name__ == '__main__':
+    main()
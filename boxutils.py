@@ -1,4 +1,6 @@
+import heapq
 import numpy as np
+from collections import defaultdict
 from pymclevel import BoundingBox
 
 from myglobals import Vector, Direction
@@ -96,6 +98,53 @@ def doTouch(box1, box2):
                 return True
     return False
 
+def _overlappingIntervals(intervals):
+    "Yield index pairs of overlapping half-open (min, max) intervals, sweeping over the sorted interval starts"
+    active = [] # heap of (max, index) of the intervals the sweep is currently inside
+    for i in sorted( range(len(intervals)), key=lambda i: intervals[i][0] ):
+        start, end = intervals[i]
+        while active and active[0][0] <= start:
+            heapq.heappop(active)
+        for _, j in active:
+            yield j, i
+        heapq.heappush(active, (end, i))
+
+def touchingPairs(boxes):
+    '''
+    All index pairs (i, j) with i < j of boxes that touch, as defined by doTouch.
+    Faces are hashed by the plane they lie in, so only boxes sharing a plane are compared.
+    '''
+    origins = [ tuple(box.origin) for box in boxes ]
+    maxima = [ tuple(box.maximum) for box in boxes ]
+    pairs = set()
+    for axis in range(3):
+        u, v = (axis+1)%3, (axis+2)%3
+        planes = defaultdict(lambda: ([], [])) # position -> (boxes ending there, boxes starting there)
+        for i in range(len(boxes)):
+            planes[ maxima[i][axis] ][0].append(i)
+            planes[ origins[i][axis] ][1].append(i)
+
+        for ending, starting in planes.values():
+            if not ending or not starting:
+                continue
+            candidates = [ (i, 0) for i in ending ] + [ (i, 1) for i in starting ]
+            intervals = [ (origins[i][u], maxima[i][u]) for i, _ in candidates ]
+            for a, b in _overlappingIntervals(intervals):
+                (i, side1), (j, side2) = candidates[a], candidates[b]
+                if side1 != side2 and i != j and _doIntervalsOverlap(origins[i][v], maxima[i][v], origins[j][v], maxima[j][v]):
+                    pairs.add( (min(i, j), max(i, j)) )
+    return pairs
+
+def overlappingPairs(boxes):
+    "All index pairs (i, j) with i < j of boxes that overlap, as defined by doOverlap"
+    origins = [ tuple(box.origin) for box in boxes ]
+    maxima = [ tuple(box.maximum) for box in boxes ]
+    pairs = set()
+    for i, j in _overlappingIntervals([ (origins[k][0], maxima[k][0]) for k in range(len(boxes)) ]):
+        if all( origins[i][axis] < maxima[j][axis] and origins[j][axis] < maxima[i][axis] for axis in (1, 2) ):
+            pairs.add( (min(i, j), max(i, j)) )
+    return pairs
+
 def touchDirection(fromBox, toBox):
     if not doTouch(fromBox, toBox):
         return None
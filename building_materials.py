@@ -1,6 +1,7 @@
 from myglobals import *
 from buildsite import WeightDict
 from pymclevel.materials import Block
+import metrics
 
 class DefaultMatBase:
     def getBaseBlock(self, orientation=Orientation.Undefined):
@@ -9,7 +10,7 @@ class DefaultMatBase:
 def commonness(site, blockOrCount):
     count = site.blockCounts[blockOrCount] if type(blockOrCount) is Block else blockOrCount
     commonnessValue = float(count) / (site.bounds.width * site.bounds.length) if count > 0 else 0.0
-    print blockOrCount, commonnessValue
+    metrics.log('commonness', commonnessValue, key=blockOrCount)
     return commonnessValue
 
 def valueModifier(site, blockOrCount, defaultCommonness):
@@ -3,13 +3,17 @@ import random
 import numpy as np
 from collections import defaultdict
 from types import FunctionType
-from pymclevel import BoundingBox, ChunkNotPresent
+from pymclevel import BoundingBox
 from pymclevel.biome_types import biome_types
 
 from myglobals import *
 import boxutils as bu
 from farming import chooseCrops
 from building_materials import getBuildMats, Wood
+from level_extensions import chunkSlices, columnHeights, columnHeightsAfterWrite, heightAfterWrite
+import parallel
+import metrics
+from sitecache import chunkHash
 
 ########################################################################
 
@@ -21,6 +25,7 @@ class Plot(BoundingBox):
 
         self.neighbours = []
         self.tags = []
+        self._excentricity = None
 
     @property
     def level(self):
@@ -34,14 +39,35 @@ class Plot(BoundingBox):
     @property
     def excentricity(self):
         "Distance of the plot's center to the site center, normalised to the size of the site"
-        bounds = self.site.bounds
-        extents = max( bounds.width/2, bounds.length/2 )
-        return min( bu.centerDistance( self, bounds ) / extents, 1 )
+        if self._excentricity is None: # neither plot nor site change, so compute it only once
+            bounds = self.site.layoutBounds
+            extents = max( bounds.width/2, bounds.length/2 )
+            self._excentricity = min( bu.centerDistance( self, bounds ) / extents, 1 )
+        return self._excentricity
 
     @property
     def centricity(self):
         return 1 - self.excentricity
 
+    # terrain statistics over the plot's columns inside the site
+
+    @property
+    def meanSurfaceHeight(self):
+        return self.site.plotStatistic('meanSurfaceHeight', self.index)
+
+    @property
+    def minSurfaceHeight(self):
+        return self.site.plotStatistic('minSurfaceHeight', self.index)
+
+    @property
+    def maxSurfaceHeight(self):
+        return self.site.plotStatistic('maxSurfaceHeight', self.index)
+
+    @property
+    def waterFraction(self):
+        "Fraction of the plot's columns with water at the surface"
+        return self.site.plotStatistic('waterFraction', self.index)
+
     def hasNeighbourWithTag(self, tag):
         return any( tag in nbr.tags for nbr in self.neighbours )
 
@@ -51,12 +77,86 @@ class Plot(BoundingBox):
 ###############################
 
 def fillInPlotNeighbours(plotList, neighboursTouch=True, neighboursOverlap=False):
-    for plot in plotList:
-        for otherPlot in plotList:
-            if otherPlot is plot:
-                continue
-            if ( bu.doTouch(plot, otherPlot) and neighboursTouch ) or ( bu.doOverlap(plot, otherPlot) and neighboursOverlap ):
-                plot.neighbours.append(otherPlot)
+    pairs = set()
+    if neighboursTouch:
+        pairs.update( bu.touchingPairs(plotList) )
+    if neighboursOverlap:
+        pairs.update( bu.overlappingPairs(plotList) )
+
+    neighbourIndices = [ [] for _ in plotList ]
+    for i, j in pairs:
+        neighbourIndices[i].append(j)
+        neighbourIndices[j].append(i)
+    # keep neighbours in the order of plotList, like a pairwise comparison would
+    for plot, indices in zip(plotList, neighbourIndices):
+        plot.neighbours.extend( plotList[k] for k in sorted(indices) )
+
+def columnRect(box, bounds):
+    "The box's columns inside bounds, as (row0, row1, col0, col1) of an array indexed [z, x] relative to bounds"
+    r0 = min( max(box.minz, bounds.minz), bounds.maxz ) - bounds.minz
+    r1 = max( min(box.maxz, bounds.maxz), bounds.minz ) - bounds.minz
+    c0 = min( max(box.minx, bounds.minx), bounds.maxx ) - bounds.minx
+    c1 = max( min(box.maxx, bounds.maxx), bounds.minx ) - bounds.minx
+    return r0, max(r0, r1), c0, max(c0, c1)
+
+def plotRaster(plotList, bounds):
+    "Array indexed [z, x] like the site heightmaps, holding the index of the plot owning each column or -1"
+    raster = np.full( (bounds.length, bounds.width), -1, dtype=np.int32 )
+    for index, plot in enumerate(plotList):
+        r0, r1, c0, c1 = columnRect(plot, bounds)
+        raster[r0:r1, c0:c1] = index
+    return raster
+
+def plotStatistics(raster, plotCount, surfaceHeights, groundHeights):
+    "Aggregate the heightmaps per plot, using the plot raster"
+    owned = raster >= 0
+    indices = raster[owned]
+    surface = surfaceHeights[owned]
+
+    area = np.maximum( np.bincount(indices, minlength=plotCount), 1 ) # avoid div by 0 for plots outside the site
+    minSurface = np.full( plotCount, np.iinfo(surface.dtype).max, dtype=surface.dtype )
+    np.minimum.at( minSurface, indices, surface )
+    maxSurface = np.full( plotCount, np.iinfo(surface.dtype).min, dtype=surface.dtype )
+    np.maximum.at( maxSurface, indices, surface )
+
+    return {
+        'meanSurfaceHeight' : np.bincount(indices, weights=surface, minlength=plotCount) / area,
+        'minSurfaceHeight'  : minSurface,
+        'maxSurfaceHeight'  : maxSurface,
+        'waterFraction'     : np.bincount(indices, weights=(surface != groundHeights[owned]), minlength=plotCount) / area,
+    }
+
+class SummedAreaTable(object):
+    "Sum, mean and variance of a 2D array over any axis-aligned rectangle in constant time"
+
+    def __init__(self, values):
+        values = values.astype(np.int64)
+        self.sums = SummedAreaTable._integrate(values)
+        self.squareSums = SummedAreaTable._integrate(values * values)
+
+    @staticmethod
+    def _integrate(values):
+        # pad with a leading row and column of zeros, so rectangles at the border need no special case
+        table = np.zeros( (values.shape[0]+1, values.shape[1]+1), dtype=np.int64 )
+        table[1:, 1:] = values.cumsum(axis=0).cumsum(axis=1)
+        return table
+
+    @staticmethod
+    def _query(table, (r0, r1, c0, c1)):
+        return table[r1, c1] - table[r0, c1] - table[r1, c0] + table[r0, c0]
+
+    def sum(self, rect):
+        "Sum over rows r0:r1 and columns c0:c1 of rect = (r0, r1, c0, c1)"
+        return SummedAreaTable._query(self.sums, rect)
+
+    def mean(self, rect):
+        r0, r1, c0, c1 = rect
+        return self.sum(rect) / ( (r1-r0) * (c1-c0) )
+
+    def variance(self, rect):
+        r0, r1, c0, c1 = rect
+        mean = self.mean(rect)
+        return SummedAreaTable._query(self.squareSums, rect) / ( (r1-r0) * (c1-c0) ) - mean * mean
 
 def filterByTag(plotList, *tags, **kwargs):
     quantifier = kwargs.get('quantifier', any)
@@ -65,8 +165,9 @@ def filterByTag(plotList, *tags, **kwargs):
 
 ########################################################################
 
-def splitIntoPlots(site):
-    backlog = [site.bounds]
+def splitIntoPlots(site, box=None):
+    "Recursively split the box (by default the whole site) into plots, separated by roads and gaps"
+    backlog = [site.bounds if box is None else box]
     results = []
     minDim = site.minPlotDim
 
@@ -118,29 +219,42 @@ def splitWithGap(box, axis, position, gapWidth):
 
 ########################################################################
 
-def countMaterialsIn(level, box):
-    # counting block by block is too much overhead, so we process full chunks
-    # this approach may not match the given bounds exactly, though
-    tmpMatDict = defaultdict(int)
-    for cx, cz in box.chunkPositions:
-        try:
-            chunk = level.getChunk(cx, cz)
-        except ChunkNotPresent:
+def chunkHistogram(chunk, slices):
+    "Count the chunk's blocks in the slices, indexed by their (ID << 4) | data code"
+    # encode (ID, data) as a single integer, so we can count with bincount
+    codes = ( chunk.Blocks[slices].astype(np.int32) << 4 ) | chunk.Data[slices]
+    return np.bincount( codes.ravel(), minlength=4096 << 4 )
+
+def materialHistogram(level, box, exactBounds=False):
+    '''
+    Count the blocks in the box, indexed by their (ID << 4) | data code.
+    By default full chunks are counted, which may not match the x/z bounds exactly;
+    set exactBounds to clip the count to the box.
+    '''
+    histogram = np.zeros(4096 << 4, dtype=np.int64)
+    for (cx, cz), slices in chunkSlices(level, box):
+        chunk = level.chunkAt(cx, cz)
+        if chunk is None:
             continue
-        # we first use (ID, data) tuples as material identifiers
-        for ui in zip( chunk.Blocks[:, :, box.miny:box.maxy].flat, chunk.Data[:, :, box.miny:box.maxy].flat ):
-            tmpMatDict[ui] += 1
+        if not exactBounds:
+            slices = slice(None), slice(None), slices[2]
+        histogram += chunkHistogram(chunk, slices)
+    return histogram
 
-    # actually, we want to return the material objects (class Block from pymclevel/materials.py)
+def materialsFromHistogram(histogram):
+    # we want to return the material objects (class Block from pymclevel/materials.py)
     # looking up the materials after aggregation significantly reduces the number of queries
     matDict = WeightDict(materials.Air)
-    for matTuple in tmpMatDict:
-        matObj = materials[matTuple]
+    for code in np.flatnonzero(histogram):
+        matObj = materials[ int(code >> 4), int(code & 0xf) ]
         assert matObj not in matDict # different IDs mapped to the same material?!
-        matDict[ matObj ] = tmpMatDict[ matTuple ]
+        matDict[ matObj ] = int( histogram[code] )
 
     return matDict
 
+def countMaterialsIn(level, box, exactBounds=False):
+    return materialsFromHistogram( materialHistogram(level, box, exactBounds) )
+
 ########################################################################
 
 def woodTypes(site):
@@ -175,57 +289,138 @@ DefaultSiteInfo = (
     ('buildMatsToValue', lambda site: WeightDict(Wood("Oak", 1), ((mat, 1./mat.value) for mat in site.buildMats))),
 )
 
-def fastHeightAt(level, (x,y,z), ignoreIDs):
-    cx = x >> 4
-    cz = z >> 4
-    xInChunk = x & 0xf
-    zInChunk = z & 0xf
-    try:
-        chunkSlice = level.getChunk(cx, cz).Blocks[xInChunk, zInChunk, :]
-    except ChunkNotPresent:
-        return y
-    # go down until we hit ground
-    while chunkSlice[y] in ignoreIDs and y > 0:
-        y -= 1
-    # go up until there is no ground above
-    while chunkSlice[y+1] not in ignoreIDs and y+1 < level.Height:
-        y += 1
-    return y
+def chunkHeights((chunkBlocks, chunkData), xSlice, zSlice, startHeight):
+    '''
+    Ground and surface heights of a chunk's columns in the slices, indexed [x, z], from its (Blocks, Data) arrays.
+    Both are computed in a single pass over the chunk.
+    '''
+    blocks = chunkBlocks[xSlice, zSlice, :]
+    data = chunkData[xSlice, zSlice, :]
+    ground = columnHeights( NON_GROUND_LUT[blocks, data], np.full(blocks.shape[:2], startHeight, dtype=int) )
+    surface = columnHeights( NON_SURFACE_LUT[blocks, data], ground )
+    return ground, surface
+
+def analyseChunks(level, box, chunkPositions):
+    '''
+    The analysis of some of the box's chunks, by chunk position: the chunk's block histogram (expanded vertically
+    like Site.blockHistogram) as nonzero codes and counts, its biome histogram and its height tile.
+    Chunks are independent, so any partition of the box's chunks can be analysed separately.
+    '''
+    countBox = box.expand(dx=0, dy=16, dz=0)
+    analyses = {}
+    for (cx, cz), (xSlice, zSlice, _) in chunkSlices(level, box, chunkPositions):
+        chunk = level.chunkAt(cx, cz)
+        if chunk is None:
+            continue
+        histogram = chunkHistogram( chunk, (slice(None), slice(None), slice( max(countBox.miny, 0), min(countBox.maxy, level.Height) )) )
+        codes = np.flatnonzero(histogram)
+        biomeHistogram = np.bincount( chunk.Biomes.ravel().astype(np.intp), minlength=256 )[:256]
+
+        ground, surface = chunkHeights( (chunk.Blocks, chunk.Data), xSlice, zSlice, box.maxy )
+        # chunk arrays are indexed [x, z], the heightmaps [z, x]
+        rect = (cz << 4) + zSlice.start - box.minz, (cz << 4) + zSlice.stop - box.minz, \
+               (cx << 4) + xSlice.start - box.minx, (cx << 4) + xSlice.stop - box.minx
+        analyses[cx, cz] = ( codes, histogram[codes], biomeHistogram, rect, ground.T, surface.T )
+
+    return analyses
+
+def analyseSite(level, box, processes=1, cache=None):
+    '''
+    Block histogram, biome histogram and ground/surface heightmaps of the box.
+    The box's chunks are sharded across worker processes and their results reduced here.
+    With a SiteCache, only chunks that changed since the box was last analysed are analysed again.
+    '''
+    # only the presence bitmap is checked here; chunks are loaded by whoever analyses them
+    chunkPositions = [ cpos for cpos in box.chunkPositions if level.hasChunk(*cpos) ]
+    analyses = {}
+    if cache is not None: # hashing has to load every chunk, but that is cheaper than analysing it
+        hashes = dict( (cpos, chunkHash(level.chunkAt(*cpos))) for cpos in chunkPositions )
+        for cpos, (cachedHash, analysis) in cache.load(box).items():
+            if hashes.get(cpos) == cachedHash:
+                analyses[cpos] = analysis
+
+    stale = [ cpos for cpos in chunkPositions if cpos not in analyses ]
+    metrics.count( 'chunksAnalysed', len(stale) )
+    metrics.count( 'chunksFromCache', len(chunkPositions) - len(stale) )
+    if stale:
+        processes = max( 1, min(processes, len(stale)) )
+        shards = [ stale[i::processes] for i in range(processes) ]
+        for partial in parallel.forkMap( lambda shard: analyseChunks(level, box, shard), shards, processes,
+                                          setup=level.reopenFiles ):
+            analyses.update(partial)
+        for cpos in filter(analyses.__contains__, stale):
+            _, counts, _, _, ground, _ = analyses[cpos]
+            metrics.count( 'blocksRead', int(counts.sum()) + ground.size * level.Height )
+        if cache is not None:
+            cache.save( box, dict( (cpos, (hashes[cpos], analyses[cpos])) for cpos in analyses ) )
+
+    histogram = np.zeros(4096 << 4, dtype=np.int64)
+    biomeHistogram = np.zeros(256, dtype=np.int64)
+    # columns in missing chunks keep their start height
+    groundHeights = np.full( (box.length, box.width), box.maxy, dtype=int )
+    surfaceHeights = groundHeights.copy()
+    for codes, counts, chunkBiomes, (r0, r1, c0, c1), ground, surface in analyses.values():
+        histogram[codes] += counts
+        biomeHistogram += chunkBiomes
+        groundHeights[r0:r1, c0:c1] = ground
+        surfaceHeights[r0:r1, c0:c1] = surface
+
+    return histogram, biomeHistogram, groundHeights, surfaceHeights
+
+def _columnsOf(box, heights):
+    "Flatten heights of the box's columns, indexed [z, x] relative to the box, to arrays of x, y and z"
+    zs, xs = np.mgrid[ box.minz:box.maxz, box.minx:box.maxx ]
+    return xs.ravel(), heights.ravel(), zs.ravel()
 
 class Site(object):
 
-    def __init__(self, level, siteBox, registrar=splitIntoPlots, **kwargs):
-        self.level = level
-        self.bounds = siteBox
+    def __init__(self, level, siteBox, registrar=splitIntoPlots, processes=1, cache=None, layoutBounds=None, **kwargs):
+        with metrics.stage('site'):
+            self.level = level
+            self.bounds = siteBox
+            # the area the settlement is laid out in; differs from the bounds for sites that are part of a larger one
+            self.layoutBounds = siteBox if layoutBounds is None else layoutBounds
+            # one extra chunk around the site covers the border that gets cleared
+            level.mapChunkPresence( siteBox.expand(dx=16, dy=0, dz=16) )
+
+            with metrics.stage('analysis'):
+                self._analyse(processes, cache)
+
+            # set up general site infos
+            with metrics.stage('siteInfo'):
+                for key, val in DefaultSiteInfo:
+                    val = kwargs.get(key, val)
+                    if isinstance(val, FunctionType):
+                        val = val(self)
+                        metrics.log(key, val)
+                    setattr( self, key, val )
+
+            # split into plots
+            with metrics.stage('plots'):
+                self.plots = registrar(self)
+                fillInPlotNeighbours(self.plots)
+                self.indexPlots()
+                self._areaTables = {}
+                metrics.count('plots', len(self.plots))
+
+            # keep the heightmaps up to date while the site is built on
+            self._dirtyColumns = np.zeros( self._groundHeights.shape, dtype=bool )
+            self._hasDirtyColumns = False
+            self._outsideTiles = {}
+            level.writeListeners.append(self._columnsWritten)
+
+    def _analyse(self, processes, cache):
+        siteBox = self.bounds
         # for the block statistics, expand vertically, so we get a better view of above- and underground features
         #? could also expand horizontally, to consider surroundings
-        self.blockCounts = countMaterialsIn( level, siteBox.expand(dx=0, dy=16, dz=0) )
-
-        # cache ground/surface heights for faster access
+        # ground/surface heights are cached for faster access
+        self.blockHistogram, biomeHistogram, self._groundHeights, self._surfaceHeights = analyseSite(self.level, siteBox, processes, cache)
+        self.blockCounts = materialsFromHistogram(self.blockHistogram)
         self.floor = bu.floor2D(siteBox)
 
-        NON_GROUND_IDS = set( block.ID for block in NON_GROUND_BLOCKS )
-        self.groundHeights = np.array( list(
-            list( fastHeightAt(level, (x, siteBox.maxy, z), NON_GROUND_IDS) for x in range(siteBox.minx, siteBox.maxx) )
-                for z in range(siteBox.minz, siteBox.maxz) ) )
-
-        NON_SURFACE_IDS = set( block.ID for block in NON_SURFACE_BLOCKS )
-        self.surfaceHeights = np.array( list(
-            list( fastHeightAt(level, (x, self.groundHeights[z-siteBox.minz][x-siteBox.minx], z), NON_SURFACE_IDS) for x in range(siteBox.minx, siteBox.maxx) )
-                for z in range(siteBox.minz, siteBox.maxz) ) )
-
         # gather biome information; biomes are stored as an ID; mapping is found in pymclevel/biome_types.py or online
-        tmpBiomeDict = defaultdict(int)
-        for cpos in siteBox.chunkPositions:
-            try:
-                chunk = level.getChunk(*cpos)
-            except ChunkNotPresent:
-                continue
-            uniques, counts = np.unique(chunk.Biomes, return_counts = True)
-            for ui, ci in zip(uniques, counts):
-                tmpBiomeDict[ui] += ci
-        self.biomes = WeightDict(1, tmpBiomeDict) # Biome(1) = Plains
-        print 'biomes =', map( lambda bID: "%s(%d): %d" % (biome_types[bID], bID, self.biomes[bID]), self.biomes )
+        self.biomes = WeightDict(1, ( (int(bID), int(biomeHistogram[bID])) for bID in np.flatnonzero(biomeHistogram) )) # Biome(1) = Plains
+        metrics.log( 'biomes', dict( ("%s(%d)" % (biome_types[bID], bID), self.biomes[bID]) for bID in self.biomes ) )
 
         # compile temperature info; range is [-0.5, 2.0]
         # mostly taken from from MC wiki; actual temperature also linked to height
@@ -240,36 +435,78 @@ class Site(object):
         # if 0.15 < temp < 1: rain possible
         # if 1 <= temp: no precipitation
         self.temperature = sum( TEMPERATURE_BY_BIOME[biome] * weight for biome, weight in self.biomes.weightedItems() )
-        print 'temperature =', self.temperature
+        metrics.log('temperature', self.temperature)
 
         # fraction of tiles with water at the surface
-        self.surfaceWaterRatio = np.sum( (self.surfaceHeights - self.groundHeights).view(dtype=bool) ) / float(self.floor.size)
-        print 'surfaceWaterRatio =', self.surfaceWaterRatio
+        self.surfaceWaterRatio = np.sum( (self._surfaceHeights - self._groundHeights).view(dtype=bool) ) / float(self.floor.size)
+        metrics.log('surfaceWaterRatio', self.surfaceWaterRatio)
 
         # could be more strict and only consider grass and dirt
-        FERTILE_BLOCKS = materials.Grass, materials.Dirt, materials["Mycelium"], materials["Podzol"], materials["Coarse"]
         # typical dirt layers seem to be 3-4 blocks deep; !! normalise against floor area of blockCount
-        self.fertileGroundRatio = sum( self.blockCounts.get(mat, 0) for mat in FERTILE_BLOCKS ) / ( 3.5 * self.floor.size )
-        print 'fertileGroundRatio =', self.fertileGroundRatio
+        self.fertileGroundRatio = self.blockHistogram[ FERTILE_LUT.ravel() ].sum() / ( 3.5 * self.floor.size )
+        metrics.log('fertileGroundRatio', self.fertileGroundRatio)
 
-        # set up general site infos
-        for key, val in DefaultSiteInfo:
-            val = kwargs.get(key, val)
-            if isinstance(val, FunctionType):
-                val = val(self)
-                print key, '=', val
-            setattr( self, key, val )
+    def detach(self):
+        "Stop following writes to the level, e.g. once the site is finished"
+        self.level.writeListeners.remove(self._columnsWritten)
 
-        # split into plots
-        self.plots = registrar(self)
-        fillInPlotNeighbours(self.plots)
+    def indexPlots(self):
+        "Number the plots and map columns to them; needed again whenever self.plots is replaced"
+        for index, plot in enumerate(self.plots):
+            plot.index = index
+        self.plotIds = plotRaster(self.plots, self.bounds)
+        self._plotStatistics = None
+        self._stalePlots = np.zeros( len(self.plots), dtype=bool )
+
+    @property
+    def plotStatistics(self):
+        "Per-plot aggregates of the heightmaps, see Plot.meanSurfaceHeight etc."
+        if self._plotStatistics is None:
+            self._plotStatistics = plotStatistics( self.plotIds, len(self.plots), self.surfaceHeights, self.groundHeights )
+            self._stalePlots[:] = False
+        for index in np.flatnonzero(self._stalePlots):
+            self._updatePlotStatistics(index)
+        return self._plotStatistics
+
+    def plotStatistic(self, name, index):
+        "A single plot's entry of plotStatistics; after writes, only the plots whose columns changed are aggregated again"
+        if self._plotStatistics is None:
+            return self.plotStatistics[name][index]
+        if self._stalePlots[index]:
+            self._updatePlotStatistics(index)
+        return self._plotStatistics[name][index]
+
+    def _updatePlotStatistics(self, index):
+        r0, r1, c0, c1 = rect = columnRect(self.plots[index], self.bounds)
+        self._rescanDirtyColumns(rect)
+        raster = np.where( self.plotIds[r0:r1, c0:c1] == index, 0, -1 )
+        statistics = plotStatistics( raster, 1, self._surfaceHeights[r0:r1, c0:c1], self._groundHeights[r0:r1, c0:c1] )
+        for name, values in statistics.items():
+            self._plotStatistics[name][index] = values[0]
+        self._stalePlots[index] = False
+
+    def _plotsChanged(self, plotIds):
+        "Mark the plots owning changed columns, given by their entries of plotIds"
+        if self._plotStatistics is not None:
+            self._stalePlots[ plotIds[plotIds >= 0] ] = True
+
+    def plotAt(self, pos):
+        "The plot owning the column at pos or None"
+        x, z = self.floor.project(pos)
+        if 0 <= x < self.bounds.width and 0 <= z < self.bounds.length:
+            index = self.plotIds[z, x]
+            if index >= 0:
+                return self.plots[index]
+        return None
 
     def groundHeightAt(self, pos):
         x, z = self.floor.project(pos)
-        if x in range(self.bounds.width) and z in range(self.bounds.length):
-            return self.groundHeights[z][x]
+        if 0 <= x < self.bounds.width and 0 <= z < self.bounds.length:
+            if self._dirtyColumns[z, x]:
+                self._rescanColumn(z, x)
+            return self._groundHeights[z, x]
         else:
-            return self.level.groundPositionAt(pos, ignoreBlocks=NON_GROUND_BLOCKS).y
+            return self._outsideTileAt(pos)[0][ pos[2] & 0xf, pos[0] & 0xf ]
 
     def groundPositionAt(self, (x,y,z)):
         return Vector(x, self.groundHeightAt((x,y,z)), z)
@@ -277,12 +514,22 @@ class Site(object):
     def groundPositions(self, box):
         return map(self.groundPositionAt, bu.ceiling(box).positions )
 
+    def groundHeightsIn(self, box):
+        "Ground heights of the box's columns, indexed [z, x] relative to the box; a view of groundHeights if the box lies inside the site"
+        return self._heightsIn(box, self.groundHeights, 0)
+
+    def groundColumns(self, box):
+        "The ground positions of the box's columns, as arrays of x, y and z"
+        return _columnsOf( box, self.groundHeightsIn(box) )
+
     def surfaceHeightAt(self, pos):
         x, z = self.floor.project(pos)
-        if x in range(self.bounds.width) and z in range(self.bounds.length):
-            return self.surfaceHeights[z][x]
+        if 0 <= x < self.bounds.width and 0 <= z < self.bounds.length:
+            if self._dirtyColumns[z, x]:
+                self._rescanColumn(z, x)
+            return self._surfaceHeights[z, x]
         else:
-            return self.level.groundPositionAt(pos, ignoreBlocks=NON_SURFACE_BLOCKS).y
+            return self._outsideTileAt(pos)[1][ pos[2] & 0xf, pos[0] & 0xf ]
 
     def surfacePositionAt(self, (x,y,z)):
         return Vector(x, self.surfaceHeightAt((x,y,z)), z)
@@ -290,5 +537,274 @@ class Site(object):
     def surfacePositions(self, box):
         return map(self.surfacePositionAt, bu.ceiling(box).positions )
 
-    def waterDepthAt(self, pos):
-        return self.surfaceHeightAt(pos) - self.groundHeightAt(pos)
+    def surfaceHeightsIn(self, box):
+        "Surface heights of the box's columns, indexed [z, x] relative to the box; a view of surfaceHeights if the box lies inside the site"
+        return self._heightsIn(box, self.surfaceHeights, 1)
+
+    def surfaceColumns(self, box):
+        "The surface positions of the box's columns, as arrays of x, y and z"
+        return _columnsOf( box, self.surfaceHeightsIn(box) )
+
+    def _heightsIn(self, box, heights, layer):
+        r0, r1, c0, c1 = columnRect(box, self.bounds)
+        if (r1 - r0, c1 - c0) == (box.length, box.width):
+            return heights[r0:r1, c0:c1]
+
+        # columns outside the site come from the chunk tiles
+        result = np.empty( (box.length, box.width), dtype=heights.dtype )
+        for cx, cz in box.chunkPositions:
+            x0, x1 = max(box.minx, cx << 4), min(box.maxx, (cx << 4) + 16)
+            z0, z1 = max(box.minz, cz << 4), min(box.maxz, (cz << 4) + 16)
+            if self.bounds.minx <= x0 and x1 <= self.bounds.maxx and self.bounds.minz <= z0 and z1 <= self.bounds.maxz:
+                continue # covered by the heightmap
+            tile = self._outsideTile(cx, cz)[layer]
+            result[ z0 - box.minz : z1 - box.minz, x0 - box.minx : x1 - box.minx ] = tile[ z0 - (cz << 4) : z1 - (cz << 4), x0 - (cx << 4) : x1 - (cx << 4) ]
+        result[ r0 + self.bounds.minz - box.minz : r1 + self.bounds.minz - box.minz,
+                c0 + self.bounds.minx - box.minx : c1 + self.bounds.minx - box.minx ] = heights[r0:r1, c0:c1]
+        return result
+
+    def _outsideTileAt(self, (x, y, z)):
+        return self._outsideTile(x >> 4, z >> 4)
+
+    def _outsideTile(self, cx, cz):
+        "Ground and surface heights of a whole chunk, indexed [z, x], for columns outside the site; computed on first use"
+        try:
+            return self._outsideTiles[cx, cz]
+        except KeyError:
+            pass
+        arrays = self.level.chunkArrays(cx, cz)
+        if arrays is None: # like in the analysis, columns in missing chunks keep their start height
+            ground = surface = np.full( (16, 16), self.bounds.maxy, dtype=int )
+        else:
+            ground, surface = chunkHeights( arrays, slice(None), slice(None), self.bounds.maxy )
+        metrics.count('outsideTiles')
+        tile = self._outsideTiles[cx, cz] = ground.T, surface.T
+        return tile
+
+    ########################################
+    # heightmap maintenance
+
+    @property
+    def groundHeights(self):
+        "Ground height of every column, indexed [z, x] relative to the site"
+        self._rescanDirtyColumns()
+        return self._groundHeights
+
+    @property
+    def surfaceHeights(self):
+        "Surface height of every column, indexed [z, x] relative to the site"
+        self._rescanDirtyColumns()
+        return self._surfaceHeights
+
+    def _columnsWritten(self, origin, maximum, ID, data, positions=None):
+        '''
+        Write listener updating the heightmaps. Most writes can be applied from the old heights alone,
+        some need the block above the write; only columns whose top is removed are marked to be scanned again.
+        Listeners are called before the write is applied, so scanning is deferred until the heights are read.
+        '''
+        # outside tiles are simply computed again
+        if self._outsideTiles:
+            cxs = range( origin[0] >> 4, ((maximum[0] - 1) >> 4) + 1 )
+            czs = range( origin[2] >> 4, ((maximum[2] - 1) >> 4) + 1 )
+            if len(cxs) * len(czs) <= len(self._outsideTiles):
+                for cpos in ( (cx, cz) for cx in cxs for cz in czs ):
+                    self._outsideTiles.pop(cpos, None)
+            else:
+                for cx, cz in self._outsideTiles.keys():
+                    if cxs[0] <= cx <= cxs[-1] and czs[0] <= cz <= czs[-1]:
+                        del self._outsideTiles[cx, cz]
+
+        bounds = self.bounds
+        if positions is not None:
+            self._blocksWritten( positions, ID, data )
+            return
+        if maximum[0] - origin[0] == maximum[1] - origin[1] == maximum[2] - origin[2] == 1 and not isinstance(ID, np.ndarray):
+            x, y, z = origin
+            if bounds.minx <= x < bounds.maxx and bounds.minz <= z < bounds.maxz and 0 <= y < self.level.Height:
+                self._blockWritten(x, y, z, ID, data)
+            return
+
+        columns = slice( max(origin[2], bounds.minz) - bounds.minz, min(maximum[2], bounds.maxz) - bounds.minz ), \
+                  slice( max(origin[0], bounds.minx) - bounds.minx, min(maximum[0], bounds.maxx) - bounds.minx )
+        y0, y1 = max(origin[1], 0), min(maximum[1], self.level.Height)
+        if columns[0].start >= columns[0].stop or columns[1].start >= columns[1].stop or y0 >= y1:
+            return
+
+        if isinstance(ID, np.ndarray):
+            # blits write arbitrary blocks, so every column they touch is scanned again
+            rows = slice( bounds.minz + columns[0].start - origin[2], bounds.minz + columns[0].stop - origin[2] )
+            cols = slice( bounds.minx + columns[1].start - origin[0], bounds.minx + columns[1].stop - origin[0] )
+            written = (ID[cols, rows] >= 0).any(axis=2).T
+            if written.any():
+                self._dirtyColumns[columns] |= written
+                self._hasDirtyColumns = True
+                self._plotsChanged( self.plotIds[columns][written] )
+            return
+
+        ground = self._groundHeights[columns]
+        surface = self._surfaceHeights[columns]
+
+        newGround, checkAbove, unknown = columnHeightsAfterWrite( ground, self.bounds.maxy, y0, y1, not NON_GROUND_LUT[ID, data] )
+        if checkAbove.any():
+            unknown |= checkAbove & ~self._ignoredAt(y1, columns, NON_GROUND_LUT)
+        newSurface, checkAbove, unknownSurface = columnHeightsAfterWrite( surface, newGround, y0, y1, not NON_SURFACE_LUT[ID, data] )
+        unknown |= unknownSurface
+        if checkAbove.any():
+            unknown |= checkAbove & ~self._ignoredAt(y1, columns, NON_SURFACE_LUT)
+
+        changed = unknown | (newGround != ground) | (newSurface != surface)
+        if not changed.any():
+            return
+        ground[...] = newGround
+        surface[...] = newSurface
+        if unknown.any():
+            self._dirtyColumns[columns] |= unknown
+            self._hasDirtyColumns = True
+        self._plotsChanged( self.plotIds[columns][changed] )
+
+    def _blockWritten(self, x, y, z, ID, data):
+        "_columnsWritten for a single block inside the site, on plain integers"
+        row, col = z - self.bounds.minz, x - self.bounds.minx
+        if self._dirtyColumns[row, col]: # scanned again anyway
+            return
+        ground, surface = int(self._groundHeights[row, col]), int(self._surfaceHeights[row, col])
+
+        newGround, checkAbove, unknown = heightAfterWrite( ground, self.bounds.maxy, y, y+1, not NON_GROUND_LUT[ID, data] )
+        if checkAbove:
+            unknown = not self._ignoredAbove(x, y, z, NON_GROUND_LUT)
+        newSurface, checkAbove, unknownSurface = heightAfterWrite( surface, newGround, y, y+1, not NON_SURFACE_LUT[ID, data] )
+        if checkAbove:
+            unknownSurface = not self._ignoredAbove(x, y, z, NON_SURFACE_LUT)
+
+        if unknown or unknownSurface:
+            self._dirtyColumns[row, col] = True
+            self._hasDirtyColumns = True
+        elif (newGround, newSurface) != (ground, surface):
+            self._groundHeights[row, col] = newGround
+            self._surfaceHeights[row, col] = newSurface
+        else:
+            return
+        index = self.plotIds[row, col]
+        if index >= 0 and self._plotStatistics is not None:
+            self._stalePlots[index] = True
+
+    def _blocksWritten(self, (xs, ys, zs), IDs, data):
+        "_columnsWritten for a batch of single blocks; columns written once are updated together"
+        bounds = self.bounds
+        inside = (xs >= bounds.minx) & (xs < bounds.maxx) & (zs >= bounds.minz) & (zs < bounds.maxz) & (ys >= 0) & (ys < self.level.Height)
+        xs, ys, zs, IDs, data = xs[inside], ys[inside], zs[inside], IDs[inside], data[inside]
+        rows, cols = zs - bounds.minz, xs - bounds.minx
+        if not len(rows):
+            return
+
+        # the result for a column written more than once depends on the order of its writes, so it is scanned again
+        _, inverse, counts = np.unique( rows * bounds.width + cols, return_inverse=True, return_counts=True )
+        repeated = counts[inverse] > 1
+        if repeated.any():
+            self._dirtyColumns[ rows[repeated], cols[repeated] ] = True
+            self._hasDirtyColumns = True
+            self._plotsChanged( self.plotIds[ rows[repeated], cols[repeated] ] )
+        # columns marked already are scanned again anyway
+        update = ~repeated & ~self._dirtyColumns[rows, cols]
+        xs, ys, zs, IDs, data, rows, cols = [ array[update] for array in (xs, ys, zs, IDs, data, rows, cols) ]
+
+        # in columns written once, the blocks above the writes are not written by the batch
+        ground, surface = self._groundHeights[rows, cols], self._surfaceHeights[rows, cols]
+        newGround, checkAbove, unknown = columnHeightsAfterWrite( ground, bounds.maxy, ys, ys+1, ~NON_GROUND_LUT[IDs, data] )
+        if checkAbove.any():
+            unknown[checkAbove] |= ~self._ignoredAboveEach( xs[checkAbove], ys[checkAbove], zs[checkAbove], NON_GROUND_LUT )
+        newSurface, checkAbove, unknownSurface = columnHeightsAfterWrite( surface, newGround, ys, ys+1, ~NON_SURFACE_LUT[IDs, data] )
+        unknown |= unknownSurface
+        if checkAbove.any():
+            unknown[checkAbove] |= ~self._ignoredAboveEach( xs[checkAbove], ys[checkAbove], zs[checkAbove], NON_SURFACE_LUT )
+
+        changed = unknown | (newGround != ground) | (newSurface != surface)
+        if not changed.any():
+            return
+        self._groundHeights[rows, cols] = newGround
+        self._surfaceHeights[rows, cols] = newSurface
+        if unknown.any():
+            self._dirtyColumns[ rows[unknown], cols[unknown] ] = True
+            self._hasDirtyColumns = True
+        self._plotsChanged( self.plotIds[ rows[changed], cols[changed] ] )
+
+    def _ignoredAboveEach(self, xs, ys, zs, lut):
+        "Mask of the positions where the block above is ignored by the lut"
+        return lut[ self.level.blocksAt(xs, ys+1, zs) ]
+
+    def _ignoredAbove(self, x, y, z, lut):
+        "Whether the block above (x, y, z) is ignored by the lut"
+        arrays = self.level.chunkArrays(x >> 4, z >> 4)
+        if arrays is None or y+1 >= self.level.Height: # missing chunks read as air
+            return True
+        return lut[ arrays[0][x & 0xf, z & 0xf, y+1], arrays[1][x & 0xf, z & 0xf, y+1] ]
+
+    def _ignoredAt(self, y, columns, lut):
+        "Mask of the columns (slices indexed [z, x]) in which the block at height y is ignored by the lut"
+        rows, cols = columns
+        ignored = np.ones( (rows.stop - rows.start, cols.stop - cols.start), dtype=bool )
+        if y >= self.level.Height:
+            return ignored
+        box = BoundingBox( (self.bounds.minx + cols.start, y, self.bounds.minz + rows.start), (ignored.shape[1], 1, ignored.shape[0]) )
+        for (cx, cz), (xSlice, zSlice, _) in chunkSlices(self.level, box):
+            arrays = self.level.chunkArrays(cx, cz)
+            if arrays is None: # missing chunks read as air
+                continue
+            slices = xSlice, zSlice, y
+            r0 = (cz << 4) + zSlice.start - box.minz
+            c0 = (cx << 4) + xSlice.start - box.minx
+            # chunk arrays are indexed [x, z]
+            ignored[ r0 : r0 + zSlice.stop - zSlice.start, c0 : c0 + xSlice.stop - xSlice.start ] = lut[ arrays[0][slices], arrays[1][slices] ].T
+        return ignored
+
+    def _rescanColumn(self, z, x):
+        wx, wz = self.bounds.minx + x, self.bounds.minz + z
+        arrays = self.level.chunkArrays(wx >> 4, wz >> 4)
+        if arrays is None: # like in the analysis, columns in missing chunks keep their start height
+            ground = surface = self.bounds.maxy
+        else:
+            ground, surface = [ heights[0, 0] for heights in
+                chunkHeights( arrays, slice(wx & 0xf, (wx & 0xf) + 1), slice(wz & 0xf, (wz & 0xf) + 1), self.bounds.maxy ) ]
+        self._groundHeights[z, x] = ground
+        self._surfaceHeights[z, x] = surface
+        self._dirtyColumns[z, x] = False
+
+    def _rescanDirtyColumns(self, rect=None):
+        "Scan the marked columns again, all of them or those in rect = (r0, r1, c0, c1)"
+        if not self._hasDirtyColumns:
+            return
+        if rect is None:
+            for z, x in zip( *np.nonzero(self._dirtyColumns) ):
+                self._rescanColumn(z, x)
+            self._hasDirtyColumns = False
+        else:
+            r0, r1, c0, c1 = rect
+            for z, x in zip( *np.nonzero(self._dirtyColumns[r0:r1, c0:c1]) ):
+                self._rescanColumn(r0 + z, c0 + x)
+
+    ########################################
+
+    def areaTable(self, layer):
+        '''
+        Summed-area table of the 'surface', 'ground' or 'waterDepth' heightmap; built on first use.
+        Tables describe the terrain as it was when they were built, later writes don't update them:
+        they are meant for judging plots before anything is built.
+        '''
+        if layer not in self._areaTables:
+            grids = {
+                'surface'    : lambda: self.surfaceHeights,
+                'ground'     : lambda: self.groundHeights,
+                'waterDepth' : lambda: self.surfaceHeights - self.groundHeights,
+            }
+            self._areaTables[layer] = SummedAreaTable( grids[layer]() )
+        return self._areaTables[layer]
+
+    def _rectOf(self, box):
+        rect = columnRect(box, self.bounds)
+        assert rect[0] < rect[1] and rect[2] < rect[3], "Box does not overlap the site"
+        return rect
+
+    def boxVariances(self, boxes, layer='surface'):
+        "Variance over each of the boxes, in one vectorized query of the table"
+        rects = tuple( np.array( [ self._rectOf(box) for box in boxes ] ).T )
+        return self.areaTable(layer).variance(rects)
@@ -0,0 +1,201 @@
+'''
+Headless consistency checks of the generator's incremental and batched code paths against
+straightforward recomputations, on the synthetic worlds of benchmark.py.
+
+Run from a directory where pymclevel is importable (e.g. MCEdit's 'stock-filters'), e.g.
+    python checks.py --seeds 0 1 2
+Exits with a non-zero status if any check finds a mismatch.
+'''
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+
+import numpy as np
+from pymclevel import BoundingBox
+
+from myglobals import *
+import boxutils as bu
+from level_extensions import inject as LVinject
+from buildsite import Site, analyseSite, plotRaster, plotStatistics, splitIntoPlots
+from construction import bidAndBuild
+from staging import VoxelBlock
+import parallel
+import metrics
+from benchmark import createWorld
+
+########################################################################
+
+# (ID, data) pairs covering solid, ground-only, surface-only and ignored blocks; flowing water has a non-zero level
+CHECK_MATERIALS = [ (0, 0), (1, 0), (2, 0), (8, 3), (9, 0), (18, 0), (78, 0), (17, 0) ]
+
+def randomWrite(level, rng, box, surface):
+    "Write random blocks near the surface through one of the level's write functions, chosen at random"
+    x = rng.randint(box.minx, box.maxx)
+    z = rng.randint(box.minz, box.maxz)
+    y = int( surface(x, z) ) + rng.randint(-3, 4)
+    mat = CHECK_MATERIALS[ rng.randint(len(CHECK_MATERIALS)) ]
+    kind = rng.randint(4)
+    if kind == 0:
+        level.setMaterialAt( (x, y, z), mat )
+    elif kind == 1:
+        level.fill( BoundingBox( (x, y, z), tuple(rng.randint(1, 5, size=3)) ), mat )
+    elif kind == 2:
+        # few distinct columns, so some are written more than once
+        count = rng.randint(1, 12)
+        xs, zs = x + rng.randint(0, 3, size=count), z + rng.randint(0, 3, size=count)
+        ys = y + rng.randint(-2, 3, size=count)
+        IDs, data = zip( *[ CHECK_MATERIALS[i] for i in rng.randint(len(CHECK_MATERIALS), size=count) ] )
+        level.setMaterialsAt( xs, ys, zs, (np.array(IDs), np.array(data)) )
+    else:
+        voxels = VoxelBlock( BoundingBox( (x, y-2, z), tuple(rng.randint(1, 6, size=3)) ) )
+        for i in range( rng.randint(1, 20) ):
+            pos = [ rng.randint(voxels.box.origin[axis], voxels.box.maximum[axis]) for axis in range(3) ]
+            voxels.setMaterialAt( pos, CHECK_MATERIALS[ rng.randint(len(CHECK_MATERIALS)) ] )
+        level.blit(voxels)
+
+def checkHeightmaps(seed, writes=400):
+    '''
+    Apply random writes while a site follows them; its heightmaps, plot statistics and the heights
+    of columns outside the site must match those of a full analysis after every write.
+    '''
+    random.seed(seed)
+    np.random.seed(seed)
+    rng = np.random.RandomState(seed)
+    level, worldBox = createWorld('forest', 80, seed)
+    LVinject(level) # unbuffered, so the analysis sees the writes
+    box = BoundingBox( (16, worldBox.miny, 16), (48, worldBox.height, 48) )
+    site = Site(level, box)
+    around = box.expand(dx=24, dy=0, dz=24) # reaches past the world's edge, where chunks are missing
+
+    mismatches = 0
+    for i in range(writes):
+        randomWrite( level, rng, around, lambda x, z: site.surfaceHeightAt((x, 0, z)) )
+
+        _, _, ground, surface = analyseSite(level, box)
+        _, _, groundAround, surfaceAround = analyseSite(level, around)
+        statistics = plotStatistics( plotRaster(site.plots, box), len(site.plots), surface, ground )
+        # query single plots first, so stale plots are aggregated one by one
+        plots = rng.permutation( len(site.plots) )[:5]
+        failed = [ name for name, same in (
+            ( 'ground'        , np.array_equal(site.groundHeights, ground) ),
+            ( 'surface'       , np.array_equal(site.surfaceHeights, surface) ),
+            ( 'groundAround'  , np.array_equal(site.groundHeightsIn(around), groundAround) ),
+            ( 'surfaceAround' , np.array_equal(site.surfaceHeightsIn(around), surfaceAround) ),
+            ( 'plotStatistics', all( np.allclose( site.plotStatistic(name, index), statistics[name][index] )
+                                     for index in plots for name in statistics ) ),
+            ) if not same ]
+        if failed:
+            print 'heightmaps: seed %d, write %d: mismatch in %s' % ( seed, i, ', '.join(failed) )
+            mismatches += 1
+    return mismatches
+
+########################################################################
+
+class LayoutSite(object):
+    "Just what splitIntoPlots needs of a site, so layouts can be made without a world"
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.minPlotDim = 5
+        self.maxPlotDim = 20
+
+def checkPairs(seed, layouts=20):
+    '''
+    touchingPairs and overlappingPairs must find the same pairs as comparing all pairs with doTouch
+    and doOverlap, on random plot layouts mixed with some random boxes that overlap them.
+    '''
+    random.seed(seed)
+    rng = np.random.RandomState(seed)
+    mismatches = 0
+    for i in range(layouts):
+        size = rng.randint(16, 160)
+        boxes = splitIntoPlots( LayoutSite( BoundingBox( (0, 0, 0), (size, 16, size) ) ) )
+        for j in range( rng.randint(0, 10) ):
+            origin = rng.randint(-4, size, size=3)
+            boxes.append( BoundingBox( tuple(origin), tuple(rng.randint(1, 24, size=3)) ) )
+
+        allPairs = [ (a, b) for a in range(len(boxes)) for b in range(a+1, len(boxes)) ]
+        for name, pairs, predicate in (
+            ( 'touching'   , bu.touchingPairs(boxes), bu.doTouch ),
+            ( 'overlapping', bu.overlappingPairs(boxes), bu.doOverlap ),
+        ):
+            if set(pairs) != set( (a, b) for a, b in allPairs if predicate(boxes[a], boxes[b]) ):
+                print 'pairs: seed %d, layout %d: %s pairs differ' % (seed, i, name)
+                mismatches += 1
+    return mismatches
+
+########################################################################
+
+def buildWorld(worldType, size, seed, processes):
+    "Generate a settlement on a fresh synthetic world with the given number of processes"
+    random.seed(seed)
+    np.random.seed(seed)
+    level, box = createWorld(worldType, size, seed)
+    LVinject(level, bufferWrites=True)
+    site = Site(level, box, processes=processes)
+    bidAndBuild(site, processes)
+    site.detach()
+    return level
+
+def checkBuildModes(seed, worldTypes=('plains', 'hills', 'forest'), size=96):
+    "Building the plots in parallel must give the same world as building them one after the other"
+    if not parallel.canFork():
+        return 0
+    mismatches = 0
+    for worldType in worldTypes:
+        sequential = buildWorld(worldType, size, seed, 1)
+        forked = buildWorld(worldType, size, seed, 2)
+        for cx, cz in sorted(sequential.allChunks):
+            chunk, other = sequential.getChunk(cx, cz), forked.getChunk(cx, cz)
+            if not ( np.array_equal(chunk.Blocks, other.Blocks) and np.array_equal(chunk.Data, other.Data) ):
+                print 'buildModes: seed %d, %s world: chunk (%d, %d) differs' % (seed, worldType, cx, cz)
+                mismatches += 1
+    return mismatches
+
+def checkReport(seed, size=64):
+    "The report of a whole run must be written and read back, including the site infos logged with non-string keys"
+    run = metrics.start(metrics.QUIET)
+    buildWorld('forest', size, seed, 1)
+    handle, path = tempfile.mkstemp(suffix='.json')
+    os.close(handle)
+    try:
+        run.writeReport(path)
+        with open(path) as report:
+            written = json.load(report)
+    finally:
+        os.remove(path)
+    mismatches = 0
+    for section in ('counters', 'tables', 'values'):
+        if written[section] != json.loads( json.dumps(run.report()[section], default=str) ):
+            print 'report: seed %d: %s differ after reading them back' % (seed, section)
+            mismatches += 1
+    return mismatches
+
+########################################################################
+
+CHECKS = {
+    'buildModes' : checkBuildModes,
+    'report'     : checkReport,
+    'heightmaps' : checkHeightmaps,
+    'pairs'      : checkPairs,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--checks', nargs='+', choices=sorted(CHECKS), default=sorted(CHECKS))
+    parser.add_argument('--seeds', nargs='+', type=int, default=[0])
+    args = parser.parse_args()
+
+    mismatches = 0
+    for name in args.checks:
+        for seed in args.seeds:
+            found = CHECKS[name](seed)
+            print '%-12s seed %-6d %s' % ( name, seed, 'ok' if not found else '%d mismatches' % found )
+            mismatches += found
+    sys.exit( 1 if mismatches else 0 )
+
+if __name__ == '__main__':
+    main()
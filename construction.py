@@ -3,18 +3,31 @@ import random
 
 from myglobals import *
 import boxutils as bu
+import parallel
+import metrics
+from level_extensions import EditRecorder, chunkSlices
 
 class Builder:
 
-    def __init__(self, askInterest, awardPlot, build):
+    def __init__(self, askInterest, awardPlot, build, askInterestBatch=None):
         self._askInterest = askInterest
         self._awardPlot = awardPlot
         self._build = build
+        self._askInterestBatch = askInterestBatch
 
     def askInterest(self, plot):
         'Return a value in [0., 1.] to indicate this builders interest in the plot.'
         return self._askInterest(plot)
 
+    def askInterests(self, plots):
+        '''
+        Return an array with the interest in each of the plots.
+        Uses the batch interest function, if the builder has one.
+        '''
+        if self._askInterestBatch is not None:
+            return np.asarray( self._askInterestBatch(plots), dtype=float )
+        return np.array( [ self._askInterest(plot) for plot in plots ], dtype=float )
+
     def awardPlot(self, plot):
         '''
         Informs the builder, that it is assigned this plot.
@@ -26,22 +39,45 @@ class Builder:
         'Actually place blocks on the plot.'
         self._build(plot)
 
+    @property
+    def name(self):
+        return self._build.__name__
+
 ########################################################################
 
 class BuilderCollective(Builder):
 
     def __init__(self, *builders):
         self.builders = builders
+        self._interests = {} # id(plot) -> interest of each builder
+
+    def interestMatrix(self, plots):
+        'Return the plots x builders matrix of interests. Each entry is only computed once.'
+        uncached = [ plot for plot in plots if id(plot) not in self._interests ]
+        if uncached:
+            columns = [ builder.askInterests(uncached) for builder in self.builders ]
+            for plot, row in zip( uncached, np.column_stack(columns) ):
+                self._interests[id(plot)] = row
+        return np.array( [ self._interests[id(plot)] for plot in plots ], dtype=float ).reshape( len(plots), len(self.builders) )
 
     def askInterest(self, plot):
-        return max( b.askInterest(plot) for b in self.builders )
+        return self.interestMatrix([plot])[0].max()
 
     def awardPlot(self, plot):
-        weights = np.array( [ b.askInterest(plot) for b in self.builders ], dtype=float )
-        if sum(weights) > 0:
-            builder = np.random.choice( self.builders, p = (weights / sum(weights)) )
-            plot.builder = builder
-            builder.awardPlot(plot)
+        self.awardPlots([plot])
+
+    def awardPlots(self, plots):
+        'Draw a builder for every plot at once, weighted by its interest, and award it the plot.'
+        interests = self.interestMatrix(plots)
+        totals = interests.sum(axis=1)
+        # the chosen builder is the first one whose cumulative weight exceeds the draw
+        draws = np.random.random_sample( len(plots) ) * totals
+        choices = np.sum( interests.cumsum(axis=1) <= draws[:, np.newaxis], axis=1 )
+        for plot, total, choice in zip(plots, totals, choices):
+            if total > 0:
+                builder = self.builders[ min(choice, len(self.builders)-1) ]
+                plot.builder = builder
+                builder.awardPlot(plot)
 
 ########################################################################
 
@@ -50,19 +86,75 @@ _registeredBuilders = []
 def register(builder):
     _registeredBuilders.append(builder)
 
-def bidAndBuild(site):
-    SITE_BORDER = (2, 10, 2)
+def builderCollective():
+    return BuilderCollective(*_registeredBuilders)
 
-    clearAboveSurface( site, site.bounds.expand(*SITE_BORDER) )
-
-    builders = BuilderCollective(*_registeredBuilders)
-    for plot in site.plots:
-        if builders.askInterest(plot):
-            builders.awardPlot(plot)
+def bidAndBuild(site, processes=1):
+    SITE_BORDER = (2, 10, 2)
 
-    for plot in site.plots:
-        if hasattr(plot, 'builder'):
+    with metrics.stage('clearing'):
+        clearAboveSurface( site, site.bounds.expand(*SITE_BORDER) )
+
+    with metrics.stage('bidding'):
+        builderCollective().awardPlots(site.plots)
+
+    with metrics.stage('building'):
+        buildPlots(site, processes)
+
+    # commit everything the builders wrote, if the level buffers its writes
+    with metrics.stage('flush'):
+        metrics.count( 'blocksFlushed', site.level.flushWrites() )
+
+def _seedPlot(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+
+def _buildRecorded(plot, seed):
+    recorder = EditRecorder()
+    plot.level.writeListeners.append(recorder)
+    try:
+        _seedPlot(seed)
+        plot.builder.build(plot)
+    finally:
+        plot.level.writeListeners.remove(recorder)
+    return recorder.records()
+
+def _countWrites(plot, written):
+    "Record how many blocks a plot's builder wrote"
+    metrics.countBy( 'blocksWrittenByBuilder', plot.builder.name, written )
+    # plot indices restart in every tile of a tiled run, the origins don't
+    metrics.countBy( 'blocksWrittenByPlot', (plot.minx, plot.minz), written )
+    metrics.count( 'blocksWritten', written )
+
+def buildPlots(site, processes=1):
+    '''
+    Let each plot's builder build it. Every plot gets its own random seed, so
+    the result doesn't depend on the order or process in which plots are built.
+    With more than one process, the plots are built in forked workers against a snapshot
+    of the site; their recorded edits are then replayed on the level in plot order.
+    Both ways give the same result, because builders only read heights of their own plot's columns;
+    for the same reason, each worker can build a batch of plots without being forked again.
+    The one exception are roads, which also pave the ends of the roads crossing them; paving
+    replaces surface blocks without changing surface heights, so it is invisible to other plots.
+    checks.py compares the two ways block by block.
+    '''
+    plots = [ plot for plot in site.plots if hasattr(plot, 'builder') ]
+    seeds = np.random.randint( 0, 2**31 - 1, size=len(plots) ).tolist()
+
+    if processes > 1 and parallel.canFork():
+        editLists = parallel.forkMap( lambda i: _buildRecorded(plots[i], seeds[i]), range(len(plots)), processes,
+                                       setup=site.level.reopenFiles )
+        # the level counts the replayed writes, since the workers' counts are lost with them
+        for plot, edits in zip(plots, editLists):
+            written = site.level.blocksWritten
+            site.level.replayEdits(edits)
+            _countWrites( plot, site.level.blocksWritten - written )
+    else:
+        for plot, seed in zip(plots, seeds):
+            written = site.level.blocksWritten
+            _seedPlot(seed)
             plot.builder.build(plot)
+            _countWrites( plot, site.level.blocksWritten - written )
 
 ########################################################################
 
@@ -124,27 +216,36 @@ def buildRoad(plot):
             pavemat = mat
             break
 
-    for ground in plot.site.surfacePositions(paveplot):
-        plot.level.setMaterialAt(ground, pavemat)
+    xs, ys, zs = plot.site.surfaceColumns(paveplot)
+    plot.level.setMaterialsAt(xs, ys, zs, pavemat)
 
 register( Builder(roadIF, noop, buildRoad) )
 
 ########################################################################
 
-@requires(notARoad)
-@requires(minimumDimensions(5))
+def houseInterests(plots):
+    'Interest in each of the plots; the flatness of all of them is looked up in one query'
+    interests = np.zeros( len(plots) )
+    eligible = [ i for i, plot in enumerate(plots) if notARoad(plot) and minimumDimensions(5)(plot) ]
+    if not eligible:
+        return interests
+    candidates = [ plots[i] for i in eligible ]
+    site = candidates[0].site # plots are bid on one site at a time
+    centricity = np.array( [ plot.centricity for plot in candidates ] )
+    roadFactor = np.array( [ 1. if plot.hasNeighbourWithTag('road') else 10. for plot in candidates ] )
+    # prefer flat plots, they need less foundation
+    interests[eligible] = centricity / roadFactor / ( 1. + site.boxVariances(candidates) )
+    return interests
+
 def houseIF(plot):
-    interest = plot.centricity
-    if not plot.hasNeighbourWithTag('road'):
-        interest /= 10.
-    return interest
+    return houseInterests([plot])[0]
 
 def markHouse(plot):
     plot.tags.append('house')
 
 from housing import buildHouse
 
-register( Builder(houseIF, markHouse, buildHouse) )
+register( Builder(houseIF, markHouse, buildHouse, askInterestBatch=houseInterests) )
 
 ########################################################################
 
@@ -167,7 +268,31 @@ register( Builder(acreIF, noop, noop) )
 ########################################################################
 
 def clearAboveSurface(site, box):
+    'Replace everything above the surface, up to the top of the box, with air. Returns the number of changed blocks.'
     level = site.level
-    for ground in site.surfacePositions(box):
-        for y in range(ground.y+1, box.maxy):
-            level.setMaterialAt( (ground.x, y, ground.z), materials.Air )
+    # indexed [z, x] relative to the box, like the site heightmaps
+    surfaceHeights = site.surfaceHeightsIn(box)
+
+    changedCount = 0
+    for (cx, cz), (xSlice, zSlice, _) in chunkSlices(level, box):
+        arrays = level.chunkArrays(cx, cz)
+        if arrays is None:
+            continue
+        # everything from the surface up is cleared, no matter where the box starts
+        slices = xSlice, zSlice, slice( 0, min(box.maxy, level.Height) )
+        xs = slice( (cx << 4) + xSlice.start - box.minx, (cx << 4) + xSlice.stop - box.minx )
+        zs = slice( (cz << 4) + zSlice.start - box.minz, (cz << 4) + zSlice.stop - box.minz )
+        heights = surfaceHeights[zs, xs].T # chunk arrays are indexed [x, z]
+
+        aboveSurface = np.arange( slices[2].stop ) > heights[..., np.newaxis]
+        changed = aboveSurface & ( (arrays[0][slices] != materials.Air.ID) | (arrays[1][slices] != 0) )
+        if not changed.any():
+            continue
+        changedCount += np.count_nonzero(changed)
+
+        blocks, data = level.writableChunkArrays(cx, cz)
+        blocks[slices][aboveSurface] = materials.Air.ID
+        data[slices][aboveSurface] = 0
+
+    metrics.count('blocksCleared', changedCount)
+    return changedCount
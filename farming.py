@@ -1,5 +1,6 @@
 import random
 import math
+import numpy as np
 from pymclevel import BoundingBox
 
 from myglobals import *
@@ -40,14 +41,16 @@ FENCE_GATE_DATA = {
     Direction.East  : 3,
 }
 
-def placeFenceGate(plot, woodName):
-    fenceGateMat = materials[woodName+" Fence Gate (Closed, South)"]
-
+def fenceGate(plot):
+    "Position and direction of the gate in a fence around the plot; to be chosen before the fence raises the surface"
     #TODO align gate to road or town centre?
     gateDir = random.choice(COMPASS_DIRECTIONS)
     gateWall = bu.wall2D(plot, gateDir)
     x, y, z = gateWall[gateWall.width/2, 0]
-    y = plot.site.surfaceHeightAt((x, y, z))
+    return (x, plot.site.surfaceHeightAt((x, y, z)), z), gateDir
+
+def placeFenceGate(plot, woodName, ((x, y, z), gateDir)):
+    fenceGateMat = materials[woodName+" Fence Gate (Closed, South)"]
     plot.level.setMaterialAt((x, y+1, z), (fenceGateMat.ID, FENCE_GATE_DATA[gateDir]) )
     plot.level.setMaterialAt((x, y+2, z), materials.Air )
 
@@ -55,23 +58,24 @@ def buildWoodFence(plot):
     woodName = plot.site.woodTypes.random()
     fenceMat = materials[woodName+" Fence"]
 
+    gate = fenceGate(plot)
     for wall in bu.walls(plot):
-        for (x,y,z) in plot.site.surfacePositions(wall):
-            plot.level.setMaterialAt((x,y+1,z), fenceMat)
-    placeFenceGate(plot, woodName)
+        xs, ys, zs = plot.site.surfaceColumns(wall)
+        plot.level.setMaterialsAt(xs, ys+1, zs, fenceMat)
+    placeFenceGate(plot, woodName, gate)
 
 
 def buildHedgeFence(plot):
     woodName = plot.site.woodTypes.random()
     hedgeMat = materials[woodName+" Leaves (No Decay)"]
-    fenceGateMat = materials[woodName+" Fence Gate (Closed, South)"]
 
+    gate = fenceGate(plot)
     for wall in bu.walls(plot):
-        for (x,y,z) in plot.site.surfacePositions(wall):
-            plot.level.setMaterialAt((x,y+1,z), hedgeMat)
-            plot.level.setMaterialAt((x,y+2,z), hedgeMat)
+        xs, ys, zs = plot.site.surfaceColumns(wall)
+        plot.level.setMaterialsAt(xs, ys+1, zs, hedgeMat)
+        plot.level.setMaterialsAt(xs, ys+2, zs, hedgeMat)
 
-    placeFenceGate(plot, woodName)
+    placeFenceGate(plot, woodName, gate)
 
 SOIL_WET = materials["Farmland (Wet, Moisture 7)"]
 SOIL_DRY = materials["Farmland (Dry, Moisture 6)"] # moisture value doesn't change visuals
@@ -92,7 +96,7 @@ def standardField(crop, plot):
     #TODO consider temperature
     if season == 'winter':
         soil = materials.Dirt
-        cropMats = materials.Air,
+        cropMats = [ (materials.Air.ID, materials.Air.blockData) ]
     else:
         soil = SOIL_WET if plot.site.surfaceWaterRatio > .1 else SOIL_DRY
         minAge = int( math.floor( crop.maxAge * SEASON_MIN_AGE[season] ) )
@@ -100,27 +104,65 @@ def standardField(crop, plot):
         cropMats = list( (crop.age0Mat.ID, age) for age in range(minAge, maxAge+1) )
 
     random.choice([buildWoodFence, buildHedgeFence, lambda _: None])(plot)
-    for ground in plot.site.surfacePositions(plot.expand(-1, 0, -1)):
-        plot.level.setMaterialAt(ground, soil)
-        plot.level.setMaterialAt(ground+Direction.Up, random.choice(cropMats))
+    xs, ys, zs = plot.site.surfaceColumns(plot.expand(-1, 0, -1))
+    cropMats = np.array(cropMats)[ np.random.randint(len(cropMats), size=len(xs)) ]
+    plot.level.setMaterialsAt(xs, ys, zs, soil)
+    plot.level.setMaterialsAt(xs, ys+1, zs, (cropMats[:, 0], cropMats[:, 1]))
 
 ########################################################################
 
 def chebyshevDist((x1,y1), (x2,y2)):
     return max( abs(x1-x2), abs(y1-y2) )
 
-def randomSpacedPositions(plot, minSpacing):
-    entityArea = (2*minSpacing + 1)**2 # square with center tile and minSpacing free tiles in both directions
-    floorArea = plot.width * plot.length
-    entityCount = floorArea / float (entityArea)
-
-    positions = [ (random.randrange(plot.width), random.randrange(plot.length)) for _ in range(int( entityCount*2 )) ]
-
-    def countConflicts(pos):
-        return sum( chebyshevDist(pos, other) <= minSpacing for other in positions if other is not pos )
-
-    while any( countConflicts(pos) > 0 for pos in positions ):
-        positions.remove( max( positions, key=countConflicts ) )
+def randomSpacedPositions(plot, minSpacing, attempts=20):
+    '''
+    Well spread random positions on the plot's floor, with more than minSpacing (chebyshev distance) between any two.
+    Poisson-disk sampling on a background grid: cells are minSpacing+1 wide, so each cell holds
+    at most one position and conflicts can only come from the 3x3 neighbouring cells.
+    '''
+    if plot.width <= 0 or plot.length <= 0:
+        return []
+
+    cellSize = minSpacing + 1
+    grid = {} # cell -> position
+
+    def cellOf((x, y)):
+        return x // cellSize, y // cellSize
+
+    def fits(pos):
+        cx, cy = cellOf(pos)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                other = grid.get( (cx+dx, cy+dy) )
+                if other is not None and chebyshevDist(pos, other) <= minSpacing:
+                    return False
+        return True
+
+    def candidateAround((x, y)):
+        # somewhere on a square ring just outside the spacing
+        dist = random.randint(minSpacing+1, 2*minSpacing+1)
+        offset = random.randint(-dist, dist)
+        sign = random.choice((-1, 1))
+        if random.random() < .5:
+            return x + sign*dist, y + offset
+        return x + offset, y + sign*dist
+
+    first = ( random.randrange(plot.width), random.randrange(plot.length) )
+    positions = [first]
+    grid[cellOf(first)] = first
+    active = [first]
+    while active:
+        index = random.randrange(len(active))
+        for _ in range(attempts):
+            pos = candidateAround(active[index])
+            if 0 <= pos[0] < plot.width and 0 <= pos[1] < plot.length and fits(pos):
+                positions.append(pos)
+                grid[cellOf(pos)] = pos
+                active.append(pos)
+                break
+        else: # no room left around this one
+            active[index] = active[-1]
+            active.pop()
 
     plotFloor = bu.floor2D(plot)
     return [ plotFloor[position] for position in positions ]
@@ -139,10 +181,11 @@ def placeTreeAt(site, position, woodName, trunkHeight):
 def orchard(crop, plot): # only works for cocoa right now
     for pos in randomSpacedPositions(plot.expand(-1,0,-1), 1):
         height = random.choice( (3,4,4,4,4,5,5) )
+        # the trunk raises the surface, so look it up before placing the tree
+        surfPos = plot.site.surfacePositionAt(pos)
         placeTreeAt(plot.site, pos, 'Jungle', height )
 
         def growAtHeight(h):
-            surfPos = plot.site.surfacePositionAt(pos)
             growDir = random.choice(COMPASS_DIRECTIONS)
             growPos = surfPos + (0, h, 0) + growDir
             fruitMat = crop.age0Mat[growDir]
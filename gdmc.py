@@ -1,13 +1,20 @@
 import random
 
 from pymclevel import MCSchematic, MCLevel, BoundingBox
-from mcplatform import *
+try:
+    from mcplatform import *
+except ImportError: # only available inside MCEdit; the filter doesn't need it to run headless
+    pass
 
 from myglobals import *
 import boxutils as bu
 from level_extensions import inject as LVinject
+from staging import StagingLevel
+from sitecache import SiteCache
 from buildsite import *
 from construction import bidAndBuild
+from streaming import buildTiled
+import metrics
 
 # name to show in filter list
 displayName = "Settlement Generator"
@@ -16,6 +23,12 @@ P_OVERRIDE_SIZE = "Override Selection Size"
 P_WIDTH = "Width"
 P_LENGTH = "Length"
 P_HEIGHT = "Height"
+P_PROCESSES = "Worker Processes"
+P_STAGING = "Stage In Memory"
+P_VERBOSITY = "Verbosity"
+P_REPORT = "Report File"
+P_CACHE = "Analysis Cache Folder"
+P_TILE_SIZE = "Tile Size"
 
 inputs = (
 	(displayName, "label"),
@@ -25,6 +38,17 @@ inputs = (
 	(P_WIDTH, 128),
 	(P_LENGTH, 128),
 	(P_HEIGHT, 16),
+	("\nAnalyse the site and build plots in parallel worker processes; 1 does everything in this process.", "label"),
+	(P_PROCESSES, (1, 1, 64)),
+	("\nGenerate into an in-memory copy of the world and commit it in one go at the end.", "label"),
+	(P_STAGING, False),
+	("\nStage timings, counters and site statistics are written as JSON to the report file (leave empty to skip).", "label"),
+	(P_VERBOSITY, ('summary', 'quiet', 'detailed')),
+	(P_REPORT, ("string", "value=settlement_report.json")),
+	("\nSite analysis results are kept in the cache folder and reused for unchanged chunks (leave empty to disable).", "label"),
+	(P_CACHE, ("string", "value=")),
+	("\nFor very large selections, generate tile by tile, with roads along the seams; 0 generates the whole selection at once.\nTiles are committed and released as soon as they are done, also when staging in memory.", "label"),
+	(P_TILE_SIZE, (0, 0, 4096)),
     )
 
 def profile(func):
@@ -37,19 +61,29 @@ def profile(func):
     return profWrapper
 
 def takeTime(func):
-    import time
     def timeWrapper(*args, **kwargs):
-	tstart = time.clock()
-	rVal = func(*args, **kwargs)
-	tend = time.clock()
-	print func.__name__, "took", tend-tstart, "seconds"
-	return rVal
+	with metrics.stage(func.__name__):
+	    return func(*args, **kwargs)
     return timeWrapper
 
 #@profile
-@takeTime
 def perform(level, box, options):
-    LVinject(level)
+    metrics.start( metrics.VERBOSITIES[options[P_VERBOSITY]] )
+    try:
+	generate(level, box, options)
+    finally:
+	if options[P_REPORT]:
+	    metrics.active().writeReport(options[P_REPORT])
+
+@takeTime
+def generate(level, box, options):
+    if options[P_STAGING]:
+	# the staging level buffers all writes by itself
+	target = StagingLevel(level)
+	LVinject(target)
+    else:
+	target = level
+	LVinject(level, bufferWrites=True)
 
     if options[P_OVERRIDE_SIZE]:
 	# expand adds on both ends, so we take the half; possible one off from rounding doesn't matter
@@ -64,9 +98,18 @@ def perform(level, box, options):
     if options[P_SEASON] != 'random':
 	siteOptions['season'] = options[P_SEASON]
 
-    site = Site(level, box, **siteOptions)
+    cache = SiteCache(options[P_CACHE]) if options[P_CACHE] else None
+    if options[P_TILE_SIZE] > 0:
+	buildTiled(target, box, options[P_TILE_SIZE], options[P_PROCESSES], cache, **siteOptions)
+    else:
+	site = Site(target, box, processes=options[P_PROCESSES], cache=cache, **siteOptions)
+	bidAndBuild(site, options[P_PROCESSES])
+
+    if options[P_STAGING]:
+	with metrics.stage('commit'):
+	    metrics.count( 'blocksCommitted', target.commit() )
 
-    bidAndBuild(site)
+    metrics.hitRate( 'chunkCache', target.chunkCache.hits, target.chunkCache.misses )
 
     # due to size override, we might have been working outside the actual selection
     # but these don't seem to trigger an update
@@ -1,22 +1,43 @@
 import random
 import numpy as np
+from collections import namedtuple, OrderedDict
 from pymclevel import BoundingBox
 
 from myglobals import *
 import boxutils as bu
+from staging import VoxelBlock
+import metrics
 
 def buildHouse(plot, **kwargs):
+    '''
+    All stages are composed in a VoxelBlock covering the house and its foundation, which is stamped onto the level once.
+    Everything above the foundation is built once per size, build material, roof style and front, and reused;
+    corner pattern and door wood vary per house and are applied to the stamped copy.
+    '''
     house = House(plot, **kwargs)
+    canvas = house.canvas = VoxelBlock( compositeBox(house) )
 
-    buildMat = plot.site.buildMatsToValue.random()
+    buildMat = house.buildMat = plot.site.buildMatsToValue.random()
     buildFoundation(buildMat, house)
 
-    buildMat = plot.site.buildMatsToValue.random()
-    buildShell(buildMat, house)
-
-    buildMat = plot.site.buildMatsToValue.random()
-    buildRoof(buildMat, house)
-    buildInterior(buildMat, house)
+    house.design = chooseDesign(house)
+    key = house.templateKey()
+    template = houseTemplates.get(key)
+    if template is None:
+        # the remaining stages draw into the template instead
+        template = house.canvas = VoxelBlock( templateBox(house) )
+        buildShell(buildMat, house)
+        buildRoof(buildMat, house)
+        buildInterior(buildMat, house)
+        houseTemplates.put(key, template)
+
+    # cheap variations between houses sharing a template are applied to the stamped copy
+    house.canvas = canvas
+    canvas.paste( template.movedTo(house.box.origin) )
+    if house.design.swapCorners:
+        orientedCorners(buildMat, house, swapped=True)
+    placeFrontDoor(house)
+    house.level.blit(canvas)
 
 ########################################################################
 
@@ -25,7 +46,7 @@ class House:
 
     def __init__(self, plot, **kwargs):
         self.plot = plot
-        groundlevel = int( np.mean( [ plot.site.surfaceHeightAt(pos) for pos in bu.floor(plot).positions ] ) )
+        groundlevel = int( plot.meanSurfaceHeight )
         self.box = BoundingBox( (plot.minx, groundlevel, plot.minz), plot.size )
 
         # front is towards the widest road
@@ -50,6 +71,15 @@ class House:
         # the roof is the final, topmost 'floor'
         self.roof = BoundingBox(self.box.origin + (0, nStoreys*(roomHeight+1), 0), (self.box.width, 1, self.box.length))
 
+        # the stages draw into canvas, see buildHouse
+        self.canvas = None
+        self.buildMat = None
+        self.design = None
+
+    def templateKey(self):
+        "What decides how the house looks above its foundation, up to the variations buildHouse applies per house"
+        return tuple(self.box.size), self.buildMat, self.design.roofStyle, self.front
+
     @property
     def level(self):
         return self.plot.level
@@ -58,25 +88,76 @@ class House:
     def site(self):
         return self.plot.site
 
+########################################################################
+# Design and templates
+########################################################################
+
+HouseDesign = namedtuple('HouseDesign', 'roofStyle swapCorners doorWood')
+
+def chooseDesign(house):
+    "Make all random choices for the stages above the foundation up front"
+    roofStyle = random.choice(ROOF_TYPES)
+    swapCorners = random.random() < .5
+    doorWood = house.site.woodTypes.random()
+    return HouseDesign(roofStyle, swapCorners, doorWood)
+
+def templateBox(house):
+    "The house's box, extended upwards to hold the highest roof"
+    return bu.expandMax( house.box, dy = max(house.box.width, house.box.length) // 2 + 2 )
+
+def compositeBox(house):
+    "The template box, extended downwards to hold the foundation"
+    box = templateBox(house)
+    bottom = min( house.site.groundHeightsIn(house.box).min() + 1, box.miny )
+    return BoundingBox( (box.minx, bottom, box.minz), (box.width, box.maxy - bottom, box.length) )
+
+class TemplateCache(object):
+    "Bounded LRU cache of house templates (VoxelBlocks), keyed by House.templateKey"
+
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.templates = OrderedDict()
+
+    def get(self, key):
+        template = self.templates.pop(key, None)
+        if template is not None:
+            self.templates[key] = template
+        metrics.count( 'houseTemplateHits' if template is not None else 'houseTemplateMisses' )
+        return template
+
+    def put(self, key, template):
+        if len(self.templates) >= self.capacity:
+            self.templates.popitem(last=False) # evict the least recently used template
+        self.templates[key] = template
+        return template
+
+houseTemplates = TemplateCache()
+
 ########################################################################
 # Foundation
 ########################################################################
 
+def columnsBetween(xs, zs, bottoms, top):
+    "Positions filling each column (xs, zs) from its bottom up to, but excluding, top; as arrays of x, y and z"
+    counts = np.maximum(top - np.asarray(bottoms), 0)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(xs, counts), np.repeat(bottoms, counts) + offsets, np.repeat(zs, counts)
+
 def filledFoundation(buildMat, house):
     fillMat = buildMat.getBaseBlock()
 
-    for pos in bu.floor( house.box ).positions:
-        ground = house.site.groundPositionAt(pos)
-        for y in range(ground.y+1, pos[1]):
-            house.level.setMaterialAt((pos[0], y, pos[2]), fillMat)
+    xs, ground, zs = house.site.groundColumns(house.box)
+    xs, ys, zs = columnsBetween(xs, zs, ground+1, house.box.miny)
+    house.canvas.setMaterialsAt(xs, ys, zs, fillMat)
 
 def pillarFoundation(buildMat, house):
     fillMat = buildMat.getBaseBlock()
 
-    for z in house.box.minz, house.box.maxz - 1:
-        for x in house.box.minx, house.box.maxx - 1:
-            for y in range(house.site.groundHeightAt((x, 0, z)) + 1, house.box.miny):
-                house.level.setMaterialAt((x, y, z), fillMat)
+    corners = [ (x, z) for z in (house.box.minz, house.box.maxz - 1) for x in (house.box.minx, house.box.maxx - 1) ]
+    xs, zs = np.array(corners).T
+    ground = np.array([ house.site.groundHeightAt((x, 0, z)) for x, z in corners ])
+    xs, ys, zs = columnsBetween(xs, zs, ground+1, house.box.miny)
+    house.canvas.setMaterialsAt(xs, ys, zs, fillMat)
 
 ####################################
 
@@ -95,9 +176,9 @@ def innerFloors(buildMat, house):
         orientation = Orientation.NorthSouth
     mat = buildMat.getBaseBlock(orientation)
 
-    house.level.fill(house.floors[0], mat)
+    house.canvas.fill(house.floors[0], mat)
     for flr in house.floors[1:]:
-        house.level.fill(flr.expand(-1, 0, -1), mat)
+        house.canvas.fill(flr.expand(-1, 0, -1), mat)
 
 # visible through the walls
 def outerFloors(buildMat, house):
@@ -107,41 +188,54 @@ def outerFloors(buildMat, house):
         orientation = Orientation.NorthSouth
     mat = buildMat.getBaseBlock(orientation)
 
-    house.level.fill(house.floors[0], mat)
+    house.canvas.fill(house.floors[0], mat)
     for flr in house.floors[1:]:
-        house.level.fill(flr, mat)
+        house.canvas.fill(flr, mat)
 
 def orientedWalls(buildMat, house):
     matNS = buildMat.getBaseBlock(Orientation.NorthSouth)
     matEW = buildMat.getBaseBlock(Orientation.EastWest)
 
     # simply fill wall first
-    house.level.fill( bu.wall(house.box, Direction.North), matEW )
-    house.level.fill( bu.wall(house.box, Direction.East),  matNS )
-    house.level.fill( bu.wall(house.box, Direction.South), matEW )
-    house.level.fill( bu.wall(house.box, Direction.West),  matNS )
+    house.canvas.fill( bu.wall(house.box, Direction.North), matEW )
+    house.canvas.fill( bu.wall(house.box, Direction.East),  matNS )
+    house.canvas.fill( bu.wall(house.box, Direction.South), matEW )
+    house.canvas.fill( bu.wall(house.box, Direction.West),  matNS )
 
     # then add variation at the corner columns
-    axes = [matEW, matNS]
-    random.shuffle(axes)
+    orientedCorners(buildMat, house)
+
+def orientedCorners(buildMat, house, swapped=False):
+    "Alternate the two orientations along the corner columns; swapped starts with the other one, skipping floors laid over the corners"
+    matNS = buildMat.getBaseBlock(Orientation.NorthSouth)
+    matEW = buildMat.getBaseBlock(Orientation.EastWest)
+    floors = house.floors if floorStyle(house) is outerFloors else house.floors[:1]
+    skipped = set( flr.miny for flr in floors ) if swapped else set()
+
+    axes = [matNS, matEW] if swapped else [matEW, matNS]
     for d1 in [Direction.North, Direction.South]:
         for d2 in [Direction.East, Direction.West]:
             for pos in bu.wall( bu.wall(house.box, d1), d2).positions:
-                house.level.setMaterialAt(pos, axes[0])
+                if pos[1] not in skipped:
+                    house.canvas.setMaterialAt(pos, axes[0])
                 axes[0], axes[1] = axes[1], axes[0]
 
 ####################################
 
+def floorStyle(house):
+    "Floors come with the roof style, so they need no templates of their own"
+    return outerFloors if house.design.roofStyle is stairRoof else innerFloors
+
 def buildShell(buildMat, house):
     orientedWalls(buildMat, house)
-    random.choice([innerFloors, outerFloors])(buildMat, house)
+    floorStyle(house)(buildMat, house)
 
 ########################################################################
 # Roof
 ########################################################################
 
 def flatRoof(buildMat, house):
-    house.level.fill(house.roof, buildMat.getBaseBlock())
+    house.canvas.fill(house.roof, buildMat.getBaseBlock())
 
 STAIR_DIRECTION_DATA = {
     Direction.East  : 1,
@@ -154,37 +248,41 @@ def stairRoof(buildMat, house):
     innerMat = buildMat.getBaseBlock()
     stairMatID = buildMat.stairID
 
+    # the roof narrows by one block per side and layer, towards the sides away from the front
+    canvas = house.canvas
+    x0, y0, z0 = [ house.roof.origin[axis] - canvas.box.origin[axis] for axis in range(3) ]
+    views = [ array[ x0 : x0 + house.roof.width, z0 : z0 + house.roof.length, y0: ] for array in (canvas.Blocks, canvas.Data, canvas.written) ]
     if house.front in [Direction.North, Direction.South]:
-        steps = -1, 0, 0
-        sides = [Direction.East, Direction.West]
-        fronts = [Direction.North, Direction.South]
-    else:
-        steps = 0, 0, -1
-        sides = [Direction.North, Direction.South]
-        fronts = [Direction.East, Direction.West]
-
-    roof = bu.expandMax(house.roof, dy=100)
-    while roof.volume > 0 and min(roof.width, roof.length) > 1:
-        layer, roof = bu.splitAlongAxisAt(roof, 1, 1)
-        for side in fronts:
-            house.level.fill( bu.wall(layer, side), innerMat )
-
-        for side in sides:
-            house.level.fill( bu.wall(layer, side), (stairMatID, STAIR_DIRECTION_DATA[side]) )
-
-        roof = roof.expand(*steps)
-
-    if min(roof.width, roof.length) == 1:
-        layer, _ = bu.splitAlongAxisAt(roof, 1, 1)
-        layer = bu.move(layer, dy=-1)
-        house.level.fill( layer, innerMat )
+        lowSide, highSide = Direction.West, Direction.East
+    else: # narrow along z instead of x
+        lowSide, highSide = Direction.North, Direction.South
+        views = [ view.transpose(1, 0, 2) for view in views ]
+    blocks, data, written = views
+    width, length, height = blocks.shape
+
+    # layer k spans [k, width-k) along the narrowing axis
+    nLayers = min( width // 2, height )
+    layers = np.arange(nLayers)
+    inLayer = ( np.arange(width)[:, np.newaxis] >= layers ) & ( np.arange(width)[:, np.newaxis] < width - layers )
+    for front in 0, length - 1:
+        for array, value in (blocks, innerMat.ID), (data, innerMat.blockData), (written, True):
+            array[:, front, :nLayers][inLayer] = value
+    for side, direction in (layers, lowSide), (width - 1 - layers, highSide):
+        blocks[side, :, layers] = stairMatID
+        data[side, :, layers] = STAIR_DIRECTION_DATA[direction]
+        written[side, :, layers] = True
+
+    # a one block wide gap at the top is closed by a ridge
+    if width % 2 == 1 and nLayers > 0:
+        ridge = width // 2, slice(None), nLayers - 1
+        blocks[ridge], data[ridge], written[ridge] = innerMat.ID, innerMat.blockData, True
 
 ####################################
 
 ROOF_TYPES = [stairRoof, flatRoof]
 
 def buildRoof(buildMat, house):
-    random.choice(ROOF_TYPES)(buildMat, house)
+    house.design.roofStyle(buildMat, house)
 
 ########################################################################
 # Interior Design
@@ -223,15 +321,15 @@ def placeWindows(level, wall):
 ########################################################################
 
 def singleRoomStoreys(house):
-    for i, s in enumerate( house.storeys ):
-        house.level.fill(s.expand(-1, 0, -1), materials.Air) # clear interior
+    for s in house.storeys:
+        house.canvas.fill(s.expand(-1, 0, -1), materials.Air) # clear interior
         for wall in bu.walls(s):
-            placeWindows(house.level, wall)
+            placeWindows(house.canvas, wall)
 
-        if i == 0: # ground floor has a door
-            frontWall = bu.wall2D(s, house.front)
-            matName = house.site.woodTypes.random()
-            placeDoor( house.level, frontWall[frontWall.width/2, 0], house.front, matName )
+def placeFrontDoor(house):
+    "The ground floor's door; placed per house, so houses sharing a template can differ in door wood"
+    frontWall = bu.wall2D(house.storeys[0], house.front)
+    placeDoor( house.canvas, frontWall[frontWall.width/2, 0], house.front, house.design.doorWood )
 
 ####################################
 
@@ -1,7 +1,10 @@
 from types import MethodType
+from collections import OrderedDict
+import numpy as np
+from pymclevel import BoundingBox, ChunkNotPresent
 
 import boxutils as bu
-from myglobals import materials, NON_GROUND_BLOCKS, Vector
+from myglobals import materials, compileLUT, NON_GROUND_LUT, Vector
 
 # list of functions to inject
 _functionsToInject = []
@@ -11,46 +14,436 @@ def injected(func):
     _functionsToInject.append(func)
     return func
 
-def inject(level):
+def inject(level, bufferWrites=False):
     for func in _functionsToInject:
         setattr( level, func.__name__, MethodType(func, level) )
+    level.chunkCache = ChunkCache(level)
+    level.writeBuffer = WriteBuffer(level) if bufferWrites else None
+    # callables notified before every write as listener(origin, maximum, ID, data, positions=None), where origin
+    # and maximum bound the write. Boxes are filled with a single ID and data. For blits, ID and data are arrays
+    # covering the box, indexed [x, z, y], with negative IDs for blocks that are left alone. Batches of single
+    # blocks pass their positions as arrays (xs, ys, zs), with one entry of ID and data per position.
+    level.writeListeners = []
+    # total number of blocks written through the functions below, e.g. to attribute writes to whoever made them
+    level.blocksWritten = 0
 
 ########################################################################
 
+class ChunkCache(object):
+    '''
+    Bounded LRU cache of chunk handles, so repeated lookups skip pymclevel's dictionaries.
+    For a mapped chunk range, a presence bitmap answers whether a chunk exists with a single array check.
+    '''
+
+    def __init__(self, level, capacity=512):
+        self.level = level
+        self.capacity = capacity
+        self.chunks = OrderedDict()
+        self.presence = None
+        self.presenceOrigin = 0, 0
+        self.hits = 0
+        self.misses = 0
+
+    def mapPresence(self, box):
+        "Precompute which chunks exist in the chunk range covered by the box"
+        self.presenceOrigin = box.mincx, box.mincz
+        self.presence = np.zeros( (box.maxcx - box.mincx, box.maxcz - box.mincz), dtype=bool )
+        for cx, cz in box.chunkPositions:
+            self.presence[cx - box.mincx, cz - box.mincz] = self.level.containsChunk(cx, cz)
+
+    def isMissing(self, cx, cz):
+        "True if the chunk is known not to exist; chunks outside the mapped range are never known to be missing"
+        if self.presence is None:
+            return False
+        px = cx - self.presenceOrigin[0]
+        pz = cz - self.presenceOrigin[1]
+        if 0 <= px < self.presence.shape[0] and 0 <= pz < self.presence.shape[1]:
+            return not self.presence[px, pz]
+        return False
+
+    def contains(self, cx, cz):
+        "Whether the chunk exists, without loading it"
+        if self.presence is not None:
+            px = cx - self.presenceOrigin[0]
+            pz = cz - self.presenceOrigin[1]
+            if 0 <= px < self.presence.shape[0] and 0 <= pz < self.presence.shape[1]:
+                return bool( self.presence[px, pz] )
+        return self.level.containsChunk(cx, cz)
+
+    def get(self, cx, cz):
+        "The chunk at (cx, cz) or None, if it doesn't exist"
+        if self.isMissing(cx, cz):
+            return None
+        chunk = self.chunks.pop( (cx, cz), None )
+        if chunk is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            try:
+                chunk = self.level.getChunk(cx, cz)
+            except ChunkNotPresent:
+                return None
+            if len(self.chunks) >= self.capacity:
+                self.chunks.popitem(last=False) # evict the least recently used chunk
+        self.chunks[cx, cz] = chunk
+        return chunk
+
+    def clear(self):
+        self.chunks.clear()
+
+@injected
+def chunkAt(level, cx, cz):
+    return level.chunkCache.get(cx, cz)
+
+@injected
+def mapChunkPresence(level, box):
+    level.chunkCache.mapPresence(box)
+
+@injected
+def hasChunk(level, cx, cz):
+    return level.chunkCache.contains(cx, cz)
+
+@injected
+def reopenFiles(level):
+    '''
+    For forked workers: forget the region files inherited from the parent process, so the worker opens its own.
+    Inherited handles share their file offsets with the parent and all other workers, so concurrent reads would interfere.
+    '''
+    source = getattr(level, 'source', None) or level # staging levels read from their source level
+    worldFolder = getattr(source, 'worldFolder', None)
+    if worldFolder is not None and hasattr(worldFolder, 'regionFiles'):
+        worldFolder.regionFiles = {}
+
+########################################################################
+
+class WriteBuffer(object):
+    '''
+    Collects block writes in per-chunk copies of the Blocks/Data arrays.
+    Nothing reaches the level until flush() commits all chunks in one go.
+    '''
+
+    def __init__(self, level):
+        self.level = level
+        self.chunkArrays = {} # (cx, cz) -> (Blocks, Data); None for missing chunks
+
+    def arraysAt(self, cx, cz):
+        "The buffered (Blocks, Data) arrays of a chunk or None, if the chunk doesn't exist"
+        try:
+            return self.chunkArrays[cx, cz]
+        except KeyError:
+            pass
+        chunk = self.level.chunkAt(cx, cz)
+        arrays = None if chunk is None else ( chunk.Blocks.copy(), chunk.Data.copy() )
+        self.chunkArrays[cx, cz] = arrays
+        return arrays
+
+    def flush(self):
+        "Commit all buffered chunks to the level. Returns the number of blocks that actually changed."
+        changedCount = 0
+        for (cx, cz), arrays in self.chunkArrays.items():
+            if arrays is None:
+                continue
+            blocks, data = arrays
+            chunk = self.level.chunkAt(cx, cz)
+            # only touch blocks that differ, so writes of identical blocks don't dirty the chunk
+            changed = (chunk.Blocks != blocks) | (chunk.Data != data)
+            count = np.count_nonzero(changed)
+            if count:
+                chunk.Blocks[changed] = blocks[changed]
+                chunk.Data[changed] = data[changed]
+                chunk.chunkChanged()
+                changedCount += count
+        self.chunkArrays.clear()
+        return changedCount
+
+@injected
+def flushWrites(level):
+    if level.writeBuffer is None:
+        return 0
+    return level.writeBuffer.flush()
+
+########################################################################
+
+def _materialIDs(mat):
+    if isinstance(mat, (list, tuple)):
+        return mat[0], mat[1]
+    return mat.ID, mat.blockData
+
 @injected
 def materialAt(level, (x,y,z)):
+    if level.writeBuffer is not None:
+        arrays = level.writeBuffer.arraysAt(x >> 4, z >> 4)
+        if arrays is not None and 0 <= y < level.Height:
+            return materials[ arrays[0][x & 0xf, z & 0xf, y], arrays[1][x & 0xf, z & 0xf, y] ]
     return materials[ level.blockAt(x,y,z), level.blockDataAt(x,y,z) ]
 
 @injected
 def setMaterialAt(level, (x,y,z), mat):
-    if isinstance(mat, (list, tuple)):
-        level.setBlockAt(x, y, z, mat[0])
-        level.setBlockDataAt(x, y, z, mat[1])
+    ID, data = _materialIDs(mat)
+    level.blocksWritten += 1
+    for listener in level.writeListeners:
+        listener( (x, y, z), (x+1, y+1, z+1), ID, data )
+    if level.writeBuffer is not None:
+        arrays = level.writeBuffer.arraysAt(x >> 4, z >> 4)
+        if arrays is not None and 0 <= y < level.Height:
+            arrays[0][x & 0xf, z & 0xf, y] = ID
+            arrays[1][x & 0xf, z & 0xf, y] = data
     else:
-        level.setBlockAt(x, y, z, mat.ID)
-        level.setBlockDataAt(x, y, z, mat.blockData)
+        level.setBlockAt(x, y, z, ID)
+        level.setBlockDataAt(x, y, z, data)
+
+@injected
+def setMaterialsAt(level, xs, ys, zs, mat):
+    '''
+    Write many single blocks at once. xs, ys and zs are equally long integer arrays; mat is a material or an (ID, data) pair,
+    where ID and data can also be arrays with one entry per position. Where positions repeat, the later write wins.
+    '''
+    xs, ys, zs = np.asarray(xs, dtype=int), np.asarray(ys, dtype=int), np.asarray(zs, dtype=int)
+    IDs, data = np.empty(xs.shape, dtype=int), np.empty(xs.shape, dtype=int)
+    IDs[:], data[:] = _materialIDs(mat)
+    level.blocksWritten += len(xs)
+    if not len(xs):
+        return
+    if level.writeListeners:
+        origin = int(xs.min()), int(ys.min()), int(zs.min())
+        maximum = int(xs.max()) + 1, int(ys.max()) + 1, int(zs.max()) + 1
+        for listener in level.writeListeners:
+            listener( origin, maximum, IDs, data, (xs, ys, zs) )
+
+    inside = (ys >= 0) & (ys < level.Height)
+    xs, ys, zs, IDs, data = xs[inside], ys[inside], zs[inside], IDs[inside], data[inside]
+    for (cx, cz), group in _chunkGroups(xs, zs):
+        arrays = writableChunkArrays(level, cx, cz)
+        if arrays is None:
+            continue
+        index = xs[group] & 0xf, zs[group] & 0xf, ys[group]
+        arrays[0][index] = IDs[group]
+        arrays[1][index] = data[group]
+
+@injected
+def blocksAt(level, xs, ys, zs):
+    "The (IDs, data) arrays of the blocks at many positions at once; missing chunks and blocks outside the level read as air"
+    xs, ys, zs = np.asarray(xs, dtype=int), np.asarray(ys, dtype=int), np.asarray(zs, dtype=int)
+    IDs, data = np.zeros(xs.shape, dtype=int), np.zeros(xs.shape, dtype=int)
+    inside = np.flatnonzero( (ys >= 0) & (ys < level.Height) )
+    for (cx, cz), group in _chunkGroups(xs[inside], zs[inside]):
+        arrays = chunkArrays(level, cx, cz)
+        if arrays is None:
+            continue
+        group = inside[group]
+        index = xs[group] & 0xf, zs[group] & 0xf, ys[group]
+        IDs[group] = arrays[0][index]
+        data[group] = arrays[1][index]
+    return IDs, data
+
+def _chunkGroups(xs, zs):
+    "Group positions by chunk. Yields ((cx, cz), indices) pairs; within a chunk, indices keep their order."
+    if not len(xs):
+        return
+    cxs, czs = xs >> 4, zs >> 4
+    order = np.lexsort( (czs, cxs) ) # the sort is stable
+    chunkStarts = np.flatnonzero( (np.diff(cxs[order]) != 0) | (np.diff(czs[order]) != 0) ) + 1
+    for group in np.split(order, chunkStarts):
+        yield ( int(cxs[group[0]]), int(czs[group[0]]) ), group
 
 ########################################################################
 
+def chunkSlices(level, box, chunkPositions=None):
+    '''
+    Split box along chunk borders. Yields ((cx, cz), slices) pairs, where the slices
+    index the part of the chunk's Blocks/Data arrays that lies inside the box.
+    chunkPositions restricts the split to some of the box's chunks.
+    '''
+    miny = max(box.miny, 0)
+    maxy = min(box.maxy, level.Height)
+    if box.width <= 0 or box.length <= 0 or miny >= maxy:
+        return
+    for cx, cz in box.chunkPositions if chunkPositions is None else chunkPositions:
+        x0 = cx << 4
+        z0 = cz << 4
+        slices = ( slice( max(box.minx, x0) - x0, min(box.maxx, x0 + 16) - x0 ),
+                   slice( max(box.minz, z0) - z0, min(box.maxz, z0 + 16) - z0 ),
+                   slice( miny, maxy ) )
+        yield (cx, cz), slices
+
+@injected
+def writableChunkArrays(level, cx, cz):
+    "The (Blocks, Data) arrays to write a chunk through or None, if the chunk doesn't exist"
+    if level.writeBuffer is not None:
+        return level.writeBuffer.arraysAt(cx, cz)
+    chunk = level.chunkAt(cx, cz)
+    if chunk is None:
+        return None
+    chunk.chunkChanged()
+    return chunk.Blocks, chunk.Data
+
 @injected
 def fill(level, box, mat):
-    for point in box.positions:
-        setMaterialAt(level, point, mat)
+    # assign whole slices per chunk instead of going block by block
+    ID, data = _materialIDs(mat)
+    level.blocksWritten += box.volume
+    for listener in level.writeListeners:
+        listener( tuple(box.origin), tuple(box.maximum), ID, data )
+    for (cx, cz), slices in chunkSlices(level, box):
+        arrays = writableChunkArrays(level, cx, cz)
+        if arrays is not None:
+            arrays[0][slices] = ID
+            arrays[1][slices] = data
+
+@injected
+def blit(level, voxels):
+    "Stamp the written blocks of a VoxelBlock onto the level"
+    blitArrays( level, voxels.box.origin, np.where(voxels.written, voxels.Blocks, -1), voxels.Data )
+
+@injected
+def blitArrays(level, origin, IDs, data):
+    "Stamp ID and data arrays, indexed [x, z, y] from origin, onto the level; negative IDs leave blocks alone"
+    box = BoundingBox( origin, IDs.shape[0:1] + IDs.shape[2:3] + IDs.shape[1:2] )
+    written = IDs >= 0
+    level.blocksWritten += int( np.count_nonzero(written) )
+    for listener in level.writeListeners:
+        listener( tuple(box.origin), tuple(box.maximum), IDs, data )
+    for (cx, cz), slices in chunkSlices(level, box):
+        arrays = writableChunkArrays(level, cx, cz)
+        if arrays is None:
+            continue
+        x0, z0 = (cx << 4) - box.minx, (cz << 4) - box.minz
+        local = slice( x0 + slices[0].start, x0 + slices[0].stop ), \
+                slice( z0 + slices[1].start, z0 + slices[1].stop ), \
+                slice( slices[2].start - box.miny, slices[2].stop - box.miny )
+        mask = written[local]
+        arrays[0][slices][mask] = IDs[local][mask]
+        arrays[1][slices][mask] = data[local][mask]
+
+########################################################################
+
+class EditRecorder(object):
+    "Write listener keeping a compact list of all edits, which can be replayed on another level"
+
+    def __init__(self):
+        self.boxes = [] # the current run of box edits
+        self.parts = [] # finished runs, block batches and blits, in order
+
+    def __call__(self, origin, maximum, ID, data, positions=None):
+        if not isinstance(ID, np.ndarray):
+            self.boxes.append( origin + maximum + (ID, data) )
+            return
+        self._endRun()
+        if positions is None:
+            # the written blocks are marked in the ID array, so a blit is recorded by its origin and arrays
+            self.parts.append( ( 'blit', ( origin, ID.astype(np.int16), data.astype(np.uint8) ) ) )
+        else:
+            self.parts.append( ( 'blocks', np.array( positions + (ID, data), dtype=np.int32 ) ) )
+
+    def _endRun(self):
+        if self.boxes:
+            self.parts.append( ( 'boxes', np.array( self.boxes, dtype=np.int32 ).reshape(-1, 8) ) )
+            self.boxes = []
+
+    def records(self):
+        '''
+        The edits as a list of (kind, record) pairs: 'boxes' with one row (minx, miny, minz, maxx, maxy, maxz, ID, data)
+        per box, 'blocks' with rows xs, ys, zs, IDs and data of a batch of single blocks; blits are ('blit', (origin, IDs, data))
+        '''
+        self._endRun()
+        return self.parts
+
+@injected
+def replayEdits(level, edits):
+    "Apply edits as recorded by an EditRecorder, in order"
+    for kind, record in edits:
+        if kind == 'blit':
+            blitArrays( level, *record )
+        elif kind == 'blocks':
+            xs, ys, zs, IDs, data = record
+            setMaterialsAt( level, xs, ys, zs, (IDs, data) )
+        else:
+            for minx, miny, minz, maxx, maxy, maxz, ID, data in record.tolist():
+                if (maxx-minx, maxy-miny, maxz-minz) == (1, 1, 1):
+                    setMaterialAt( level, (minx, miny, minz), (ID, data) )
+                else:
+                    fill( level, BoundingBox((minx, miny, minz), (maxx-minx, maxy-miny, maxz-minz)), (ID, data) )
 
 ########################################################################
 
 @injected
-def groundPositionAt(level, (x,y,z), ignoreBlocks=NON_GROUND_BLOCKS):
-    # go down until we hit ground
-    while materialAt(level, (x,y,z)) in ignoreBlocks and y > 0:
-        y -= 1
-    # go up until there is no ground above
-    while materialAt(level, (x,y+1,z)) not in ignoreBlocks and y+1 < level.Height:
-        y += 1
-    return Vector(x,y,z)
+def chunkArrays(level, cx, cz):
+    "The current (Blocks, Data) arrays of a chunk, including buffered writes; None if the chunk doesn't exist"
+    if level.writeBuffer is not None and (cx, cz) in level.writeBuffer.chunkArrays:
+        return level.writeBuffer.chunkArrays[cx, cz]
+    chunk = level.chunkAt(cx, cz)
+    if chunk is None:
+        return None
+    return chunk.Blocks, chunk.Data
+
+def columnHeights(ignored, startHeights):
+    '''
+    For every column, go down from its start height until a block that isn't ignored is hit,
+    then go up again until there is an ignored block above. ignored is a boolean array
+    indexed [x, z, y], startHeights is indexed [x, z].
+    '''
+    height = ignored.shape[2]
+    ys = np.arange(height)
+    startHeights = np.clip(startHeights, 0, height-1)
+
+    # go down until we hit ground; the topmost solid block at or below the start
+    solidBelow = ~ignored & (ys <= startHeights[..., np.newaxis])
+    heights = np.where( solidBelow.any(axis=2), height-1 - np.argmax(solidBelow[:, :, ::-1], axis=2), 0 )
+
+    # go up until there is no ground above; the first ignored block above, minus one
+    ignoredAbove = ignored & (ys > heights[..., np.newaxis])
+    return np.where( ignoredAbove.any(axis=2), np.argmax(ignoredAbove, axis=2) - 1, height-1 )
+
+def columnHeightsAfterWrite(heights, startHeights, y0, y1, solid):
+    '''
+    Update heights as computed by columnHeights for a write to [y0, y1) in every column, without looking
+    at the columns. solid tells if the written block isn't ignored; like y0 and y1, it may be an array with
+    one entry per column. Returns the new heights and two masks:
+    checkAbove - the new height is only right if the block at y1 is ignored
+    unknown    - the column has to be scanned again
+    '''
+    solid = np.asarray(solid, dtype=bool)
+    # the topmost solid block at or below the start
+    top = np.minimum(heights, startHeights)
+    # a solid write raises the column if it reaches above the current height and either sits
+    # right on top of it or is at or below the start; above y1 only the start height guarantees air
+    grows = solid & (y1-1 > heights) & (y0 <= np.maximum(heights + 1, startHeights))
+    # an ignored write cuts the column if it hits the solid run from the top down to the height;
+    # cutting above the top is exact, removing the top itself means searching further down
+    cut = ~solid & (y0 <= heights) & (y1-1 >= top)
+    newHeights = np.where( grows, y1-1, np.where(cut & (y0 > top), y0-1, heights) )
+    return newHeights, grows & (y1 > startHeights), cut & (y0 <= top)
+
+def heightAfterWrite(height, startHeight, y0, y1, solid):
+    "columnHeightsAfterWrite for a single column, on plain integers; numpy's overhead dominates for single blocks"
+    if solid:
+        if y1-1 > height and y0 <= max(height + 1, startHeight):
+            return y1-1, y1 > startHeight, False
+        return height, False, False
+    top = min(height, startHeight)
+    if y0 <= height and y1-1 >= top:
+        if y0 > top:
+            return y0-1, False, False
+        return height, False, True
+    return height, False, False
+
+@injected
+def groundPositionAt(level, (x,y,z), ignoreBlocks=NON_GROUND_LUT):
+    if not isinstance(ignoreBlocks, np.ndarray):
+        ignoreBlocks = compileLUT(ignoreBlocks)
+    arrays = chunkArrays(level, x >> 4, z >> 4)
+    if arrays is None: # missing chunks read as air all the way down
+        return Vector(x, 0, z)
+
+    # classify the whole column at once
+    column = slice(x & 0xf, (x & 0xf) + 1), slice(z & 0xf, (z & 0xf) + 1), slice(None)
+    ignored = ignoreBlocks[ arrays[0][column], arrays[1][column] ]
+    return Vector( x, int( columnHeights(ignored, np.array([[y]]))[0, 0] ), z )
 
 @injected
-def groundPositions(level, box, doBoxClip=False, ignoreBlocks=NON_GROUND_BLOCKS):
+def groundPositions(level, box, doBoxClip=False, ignoreBlocks=NON_GROUND_LUT):
+    if not isinstance(ignoreBlocks, np.ndarray):
+        ignoreBlocks = compileLUT(ignoreBlocks)
     for pos in bu.ceiling(box).positions:
         if doBoxClip:
             yield bu.clip(groundPositionAt(level, pos, ignoreBlocks), box)
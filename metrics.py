@@ -0,0 +1,110 @@
+'''
+Structured diagnostics of a generator run: nested stage timings, counters and logged values.
+Modules report to the active Metrics through the functions at the bottom; perform starts
+a new one per run and writes its report as JSON.
+'''
+import json
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+QUIET, SUMMARY, DETAILED = range(3)
+VERBOSITIES = { 'quiet' : QUIET, 'summary' : SUMMARY, 'detailed' : DETAILED }
+
+def _jsonable(value):
+    "Copy of value with string keys in all dicts, since json can't write other keys; other leaves are written with str"
+    if isinstance(value, dict):
+        return dict( (key if isinstance(key, basestring) else str(key), _jsonable(item)) for key, item in value.items() )
+    if isinstance(value, (list, tuple)):
+        return [ _jsonable(item) for item in value ]
+    return value
+
+class Metrics(object):
+    '''
+    QUIET only records, SUMMARY also prints stage timings as they finish,
+    DETAILED additionally prints every logged value.
+    '''
+
+    def __init__(self, verbosity=SUMMARY):
+        self.verbosity = verbosity
+        self.root = { 'name' : 'run', 'stages' : [] }
+        self._openStages = [self.root]
+        self.counters = defaultdict(int)
+        self.tables = defaultdict(lambda: defaultdict(int)) # table -> key -> summed amount
+        self.values = {}
+
+    @contextmanager
+    def stage(self, name):
+        "Time the enclosed block as a sub-stage of the currently open stage"
+        node = { 'name' : name, 'stages' : [] }
+        self._openStages[-1]['stages'].append(node)
+        self._openStages.append(node)
+        tstart = time.time()
+        try:
+            yield node
+        finally:
+            node['seconds'] = time.time() - tstart
+            self._openStages.pop()
+            if self.verbosity >= SUMMARY:
+                print '  ' * (len(self._openStages) - 1) + name, 'took', node['seconds'], 'seconds'
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    def countBy(self, table, key, amount=1):
+        "Add amount to the entry for key in the table, e.g. blocks written per builder"
+        self.tables[table][str(key)] += amount
+
+    def log(self, name, value, key=None):
+        "Record a value; with a key, the value is stored in a table under that key"
+        if key is None:
+            self.values[name] = value
+        else:
+            self.values.setdefault(name, {})[str(key)] = value
+        if self.verbosity >= DETAILED:
+            print name if key is None else '%s[%s]' % (name, key), '=', value
+
+    def hitRate(self, name, hits, misses):
+        "Record the hit rate of a cache"
+        total = hits + misses
+        self.values[name] = { 'hits' : hits, 'misses' : misses, 'hitRate' : hits / float(total) if total else None }
+
+    def report(self):
+        return {
+            'stages'   : self.root['stages'],
+            'counters' : dict(self.counters),
+            'tables'   : dict( (name, dict(table)) for name, table in self.tables.items() ),
+            'values'   : _jsonable(self.values),
+        }
+
+    def writeReport(self, path):
+        with open(path, 'w') as out:
+            json.dump( self.report(), out, indent=2, sort_keys=True, default=str )
+
+########################################################################
+
+_active = Metrics(QUIET)
+
+def start(verbosity=SUMMARY):
+    "Make a new Metrics the active one and return it"
+    global _active
+    _active = Metrics(verbosity)
+    return _active
+
+def active():
+    return _active
+
+def stage(name):
+    return _active.stage(name)
+
+def count(name, amount=1):
+    _active.count(name, amount)
+
+def countBy(table, key, amount=1):
+    _active.countBy(table, key, amount)
+
+def log(name, value, key=None):
+    _active.log(name, value, key)
+
+def hitRate(name, hits, misses):
+    _active.hitRate(name, hits, misses)
@@ -1,3 +1,5 @@
+from bisect import bisect_right
+import numpy as np
 from pymclevel import alphaMaterials as materials
 
 from pymclevel.box import Vector
@@ -57,23 +59,67 @@ class Orientation:
         return Undefined
 
 class WeightDict(dict):
+    '''
+    Maps keys to (non-negative) weights. The normalisation and cumulative distribution
+    are cached until the next mutation, so drawing a key is a bisection.
+    '''
 
     def __init__(self, default, basedict={}):
         super(WeightDict, self).__init__(basedict)
         self.default = default
+        self._distribution = None
 
-    def random(self):
-        from numpy import random
+    # any mutation invalidates the cached distribution
+
+    def __setitem__(self, key, value):
+        super(WeightDict, self).__setitem__(key, value)
+        self._distribution = None
+
+    def __delitem__(self, key):
+        super(WeightDict, self).__delitem__(key)
+        self._distribution = None
+
+    def clear(self):
+        super(WeightDict, self).clear()
+        self._distribution = None
+
+    def pop(self, *args):
+        self._distribution = None
+        return super(WeightDict, self).pop(*args)
+
+    def popitem(self):
+        self._distribution = None
+        return super(WeightDict, self).popitem()
 
-        norm = float(sum(self.values()))
-        keys = self.keys()
-        if norm:
-            return random.choice( keys, p = [self[key]/norm for key in keys] )
-        else:
+    def setdefault(self, key, default=None):
+        self._distribution = None
+        return super(WeightDict, self).setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        super(WeightDict, self).update(*args, **kwargs)
+        self._distribution = None
+
+    def distribution(self):
+        "The keys and their cumulative weights, as a list each"
+        if self._distribution is None:
+            keys = self.keys()
+            self._distribution = keys, np.cumsum( [ self[key] for key in keys ], dtype=float ).tolist()
+        return self._distribution
+
+    def total(self):
+        _, cumulative = self.distribution()
+        return cumulative[-1] if cumulative else 0
+
+    def random(self):
+        norm = self.total()
+        if not norm:
             return self.default
+        keys, cumulative = self.distribution()
+        index = bisect_right( cumulative, np.random.random_sample() * norm )
+        return keys[ min(index, len(keys)-1) ]
 
     def mostCommon(self):
-        if not self or not sum(self.values()):
+        if not self or not self.total():
             return self.default
         maxWeight = max(self.values())
         for key, weight in self.items():
@@ -81,7 +127,7 @@ class WeightDict(dict):
                 return key
 
     def leastCommon(self):
-        if not self or not sum(self.values()):
+        if not self or not self.total():
             return self.default
         minWeight = min(self.values())
         for key, weight in self.items():
@@ -90,7 +136,7 @@ class WeightDict(dict):
 
     def weight(self, key):
         if self.isNonZero(key): # also ensures we don't div by 0
-            return self[key] / float(sum(self.values()))
+            return self[key] / self.total()
         return 0
 
     def weightedItems(self):
@@ -119,3 +165,29 @@ NON_SURFACE_BLOCKS  = set( [materials.Air] + materials.blocksMatching("snow") +
         list(btype for btypeClass in BLOCK_TYPES_GROWTHS for btype in materials.blocksByType[btypeClass]) )
 
 NON_GROUND_BLOCKS = NON_SURFACE_BLOCKS.union( materials.blocksMatching("water") ).union( [ materials.Ice, materials.PackedIce, materials.FrostedIce ] )
+
+FERTILE_BLOCKS = set( [ materials.Grass, materials.Dirt, materials["Mycelium"], materials["Podzol"], materials["Coarse"] ] )
+
+GROWTH_BLOCKS = set( btype for btypeClass in BLOCK_TYPES_GROWTHS for btype in materials.blocksByType[btypeClass] )
+
+def compileLUT(blocks):
+    '''
+    Compile a set of blocks into a boolean lookup table indexed [ID, data].
+    IDs whose known variants are all in the set get their whole row marked: the data values
+    the material table doesn't list are block states, like water levels, leaf decay or snow layers.
+    '''
+    table = np.zeros((4096, 16), dtype=bool) # anvil block IDs have up to 12 bits, data 4
+    for block in blocks:
+        table[block.ID, block.blockData] = True
+    known = np.zeros_like(table)
+    for block in materials.allBlocks:
+        known[block.ID, block.blockData & 15] = True
+    table[ table.any(axis=1) & (table | ~known).all(axis=1) ] = True
+    return table
+
+# tables to classify whole Blocks/Data arrays at once, e.g. NON_GROUND_LUT[chunk.Blocks, chunk.Data]
+# flattened, they match the (ID << 4) | data codes of block histograms
+NON_SURFACE_LUT = compileLUT(NON_SURFACE_BLOCKS)
+NON_GROUND_LUT  = compileLUT(NON_GROUND_BLOCKS)
+FERTILE_LUT     = compileLUT(FERTILE_BLOCKS)
+GROWTH_LUT      = compileLUT(GROWTH_BLOCKS)
@@ -0,0 +1,37 @@
+import os
+import multiprocessing
+
+# the function mapped by forkMap and the worker setup; workers inherit them when they are forked
+_task = None
+_setup = None
+
+def _runTask(item):
+    return _task(item)
+
+def _setupWorker():
+    if _setup is not None:
+        _setup()
+
+def canFork():
+    return hasattr(os, 'fork')
+
+def forkMap(func, items, processes, setup=None):
+    '''
+    Map func over items in worker processes forked from this one. The workers inherit
+    all state of this process, so only items and results have to be picklable.
+    Workers process batches of items, so an item may see the side effects of items processed before it in the same worker.
+    setup is called once in each worker after it is forked, e.g. to drop inherited file handles.
+    Falls back to a plain map, if there is only one process or forking isn't supported.
+    '''
+    global _task, _setup
+    if processes <= 1 or not canFork():
+        return map(func, items)
+
+    _task, _setup = func, setup
+    pool = multiprocessing.Pool( processes, initializer=_setupWorker )
+    try:
+        return pool.map(_runTask, items)
+    finally:
+        pool.close()
+        pool.join()
+        _task = _setup = None
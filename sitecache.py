@@ -0,0 +1,117 @@
+'''
+Persistent cache of the site analysis. Results are stored per chunk as compressed numpy archives,
+one file per selection, together with a hash of each chunk's block, data and biome arrays.
+Chunks whose hash still matches don't need to be analysed again.
+'''
+import hashlib
+import os
+import numpy as np
+
+from myglobals import NON_GROUND_LUT, NON_SURFACE_LUT
+
+# bump whenever the analysis of a chunk changes, so archives written by older versions are ignored
+ANALYSIS_VERSION = 2
+
+def analysisTag():
+    "Identifies how entries were computed: the analysis version and the block classification it used"
+    digest = hashlib.sha1()
+    for lut in (NON_GROUND_LUT, NON_SURFACE_LUT):
+        digest.update( np.packbits(lut).data )
+    return 'v%d_%s' % (ANALYSIS_VERSION, digest.hexdigest()[:8])
+
+def chunkHash(chunk):
+    "Hex digest of the chunk's Blocks, Data and Biomes arrays"
+    digest = hashlib.sha1()
+    for array in (chunk.Blocks, chunk.Data, getattr(chunk, 'Biomes', None)):
+        if array is not None:
+            digest.update( np.ascontiguousarray(array).data )
+    return digest.hexdigest()
+
+class SiteCache(object):
+    '''
+    Maps chunk positions to (hash, analysis), where analysis is a chunk's entry as returned by
+    buildsite.analyseChunks: (histogramCodes, histogramCounts, biomeHistogram, rect, ground, surface).
+    Entries depend on the selection bounds (vertical range, clipping at the borders), so each selection gets its own file.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, box):
+        return os.path.join( self.directory, 'site_%s_%d_%d_%d_%d_%d_%d.npz' % (
+            analysisTag(), box.minx, box.miny, box.minz, box.maxx, box.maxy, box.maxz) )
+
+    def load(self, box):
+        "The cached entries for the box; empty if there are none or the file can't be read"
+        try:
+            archive = np.load( self.path(box) )
+            try:
+                return self._unpack(archive)
+            finally:
+                archive.close()
+        except (IOError, OSError, ValueError, KeyError):
+            return {}
+
+    def save(self, box, entries):
+        "Store the entries for the box; returns False if they couldn't be written, e.g. to a read-only directory"
+        path = self.path(box)
+        tmpPath = path[:-len('.npz')] + '.tmp.npz'
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            # write to a temporary file first, so an interrupted run doesn't leave a broken archive behind
+            np.savez_compressed( tmpPath, **self._pack(entries) )
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(tmpPath, path)
+        except (IOError, OSError) as error:
+            print 'could not write the site cache:', error
+            return False
+        return True
+
+    ####################################
+
+    @staticmethod
+    def _pack(entries):
+        positions = sorted(entries)
+        hashes = [ entries[cpos][0] for cpos in positions ]
+        analyses = [ entries[cpos][1] for cpos in positions ]
+        def concatenated(arrays, dtype):
+            arrays = [ np.asarray(array, dtype=dtype).ravel() for array in arrays ]
+            return np.concatenate(arrays) if arrays else np.zeros(0, dtype=dtype)
+        return {
+            'positions'  : np.array( positions, dtype=np.int32 ).reshape(-1, 2),
+            'hashes'     : np.array( hashes, dtype='S40' ),
+            'histSizes'  : np.array( [ len(codes) for codes, _, _, _, _, _ in analyses ], dtype=np.int64 ),
+            'histCodes'  : concatenated( [ analysis[0] for analysis in analyses ], np.int32 ),
+            'histCounts' : concatenated( [ analysis[1] for analysis in analyses ], np.int64 ),
+            'biomes'     : np.array( [ analysis[2] for analysis in analyses ], dtype=np.int64 ).reshape(-1, 256),
+            'rects'      : np.array( [ analysis[3] for analysis in analyses ], dtype=np.int32 ).reshape(-1, 4),
+            'ground'     : concatenated( [ analysis[4] for analysis in analyses ], np.int32 ),
+            'surface'    : concatenated( [ analysis[5] for analysis in analyses ], np.int32 ),
+        }
+
+    @staticmethod
+    def _unpack(archive):
+        entries = {}
+        histOffsets = np.concatenate( ([0], np.cumsum(archive['histSizes'])) )
+        tileOffset = 0
+        histCodes, histCounts = archive['histCodes'], archive['histCounts']
+        ground, surface = archive['ground'], archive['surface']
+        # every access to an archive member decompresses it again, so read each one only once
+        rects, biomes, hashes = archive['rects'].tolist(), archive['biomes'], archive['hashes']
+        for i, (cx, cz) in enumerate( archive['positions'].tolist() ):
+            r0, r1, c0, c1 = rect = tuple( rects[i] )
+            shape = r1 - r0, c1 - c0
+            tileSize = shape[0] * shape[1]
+            analysis = (
+                histCodes[ histOffsets[i] : histOffsets[i+1] ].astype(np.intp),
+                histCounts[ histOffsets[i] : histOffsets[i+1] ],
+                biomes[i],
+                rect,
+                ground[ tileOffset : tileOffset + tileSize ].reshape(shape).astype(int),
+                surface[ tileOffset : tileOffset + tileSize ].reshape(shape).astype(int),
+            )
+            tileOffset += tileSize
+            entries[cx, cz] = ( hashes[i].decode('ascii'), analysis )
+        return entries
@@ -0,0 +1,198 @@
+import numpy as np
+from pymclevel import BoundingBox, ChunkNotPresent
+
+from level_extensions import _materialIDs
+
+class StagingChunk(object):
+    "A chunk held in plain numpy arrays, indexed like pymclevel's: Blocks/Data [x, z, y], Biomes [z, x]"
+
+    def __init__(self, chunkPosition, blocks, data, biomes):
+        self.chunkPosition = chunkPosition
+        self.Blocks = blocks
+        self.Data = data
+        self.Biomes = biomes
+        self.dirty = False
+
+    @classmethod
+    def empty(cls, chunkPosition, height):
+        return cls( chunkPosition,
+            np.zeros((16, 16, height), dtype=np.uint16),
+            np.zeros((16, 16, height), dtype=np.uint8),
+            np.ones((16, 16), dtype=np.uint8) ) # Biome(1) = Plains
+
+    @classmethod
+    def copyOf(cls, chunkPosition, chunk):
+        biomes = getattr(chunk, 'Biomes', None)
+        return cls( chunkPosition,
+            np.array(chunk.Blocks, dtype=np.uint16),
+            np.array(chunk.Data, dtype=np.uint8),
+            np.ones((16, 16), dtype=np.uint8) if biomes is None else np.array(biomes) )
+
+    def chunkChanged(self, needsLighting=True):
+        self.dirty = True
+
+class StagingLevel(object):
+    '''
+    Stand-in for the parts of a pymclevel level this project uses, backed by numpy arrays.
+    Chunks are copied from the source level when they are first accessed (or via load),
+    so a whole settlement can be generated here and committed to the source in one go.
+    Without a source, the level only contains the chunks created on it.
+    '''
+
+    def __init__(self, source=None, height=256):
+        self.source = source
+        self.Height = source.Height if source is not None else height
+        self._chunks = {}
+
+    ####################################
+    # chunks
+
+    def containsChunk(self, cx, cz):
+        if (cx, cz) in self._chunks:
+            return True
+        return self.source is not None and self.source.containsChunk(cx, cz)
+
+    def getChunk(self, cx, cz):
+        try:
+            return self._chunks[cx, cz]
+        except KeyError:
+            pass
+        if self.source is None:
+            raise ChunkNotPresent( (cx, cz) )
+        chunk = self._chunks[cx, cz] = StagingChunk.copyOf( (cx, cz), self.source.getChunk(cx, cz) )
+        return chunk
+
+    def createChunk(self, cx, cz):
+        self._chunks[cx, cz] = StagingChunk.empty( (cx, cz), self.Height )
+        return self._chunks[cx, cz]
+
+    @property
+    def allChunks(self):
+        if self.source is None:
+            return list(self._chunks)
+        return list( set(self._chunks).union(self.source.allChunks) )
+
+    @property
+    def stagedChunks(self):
+        return list(self._chunks)
+
+    def load(self, box):
+        "Stage all existing chunks of the box up front"
+        for cx, cz in box.chunkPositions:
+            if self.containsChunk(cx, cz):
+                self.getChunk(cx, cz)
+
+    def release(self, box=None):
+        "Forget staged chunks (in the box), e.g. after committing them"
+        for cpos in list(self._chunks):
+            if box is None or ( box.mincx <= cpos[0] < box.maxcx and box.mincz <= cpos[1] < box.maxcz ):
+                del self._chunks[cpos]
+
+    def commit(self, box=None):
+        '''
+        Copy the changed chunks (in the box) back to the source level, only touching blocks that differ.
+        Returns the number of blocks that changed in the source.
+        '''
+        changedCount = 0
+        for (cx, cz), staged in self._chunks.items():
+            if not staged.dirty:
+                continue
+            if box is not None and not ( box.mincx <= cx < box.maxcx and box.mincz <= cz < box.maxcz ):
+                continue
+            chunk = self.source.getChunk(cx, cz)
+            changed = (chunk.Blocks != staged.Blocks) | (chunk.Data != staged.Data)
+            count = np.count_nonzero(changed)
+            if count:
+                chunk.Blocks[changed] = staged.Blocks[changed]
+                chunk.Data[changed] = staged.Data[changed]
+                chunk.chunkChanged()
+                changedCount += count
+            staged.dirty = False
+        return changedCount
+
+    ####################################
+    # single blocks; missing chunks and positions outside the height range read as air
+
+    def _chunkFor(self, x, y, z):
+        if not 0 <= y < self.Height:
+            return None
+        try:
+            return self.getChunk(x >> 4, z >> 4)
+        except ChunkNotPresent:
+            return None
+
+    def blockAt(self, x, y, z):
+        chunk = self._chunkFor(x, y, z)
+        return 0 if chunk is None else chunk.Blocks[x & 0xf, z & 0xf, y]
+
+    def blockDataAt(self, x, y, z):
+        chunk = self._chunkFor(x, y, z)
+        return 0 if chunk is None else chunk.Data[x & 0xf, z & 0xf, y]
+
+    def setBlockAt(self, x, y, z, blockID):
+        chunk = self._chunkFor(x, y, z)
+        if chunk is not None:
+            chunk.Blocks[x & 0xf, z & 0xf, y] = blockID
+            chunk.chunkChanged()
+
+    def setBlockDataAt(self, x, y, z, data):
+        chunk = self._chunkFor(x, y, z)
+        if chunk is not None:
+            chunk.Data[x & 0xf, z & 0xf, y] = data
+            chunk.chunkChanged()
+
+class VoxelBlock(object):
+    '''
+    A box of blocks held in numpy arrays (indexed [x, z, y] like chunks), which builders can write to
+    like to a level, in world coordinates. Writes outside the box are dropped. Only blocks that were written
+    are copied when the block is stamped onto a level with level.blit.
+    '''
+
+    def __init__(self, box):
+        self.box = box
+        shape = box.width, box.length, box.height
+        self.Blocks = np.zeros(shape, dtype=np.uint16)
+        self.Data = np.zeros(shape, dtype=np.uint8)
+        self.written = np.zeros(shape, dtype=bool)
+
+    def movedTo(self, origin):
+        "The same blocks at another origin; the arrays are shared, not copied"
+        moved = VoxelBlock.__new__(VoxelBlock)
+        moved.box = BoundingBox(origin, self.box.size)
+        moved.Blocks, moved.Data, moved.written = self.Blocks, self.Data, self.written
+        return moved
+
+    def _slices(self, box):
+        "Slices of the arrays covering the part of box inside this block"
+        return tuple( slice( max(box.origin[axis] - self.box.origin[axis], 0),
+                             max( min(box.maximum[axis], self.box.maximum[axis]) - self.box.origin[axis], 0 ) )
+                      for axis in (0, 2, 1) )
+
+    def setMaterialAt(self, (x,y,z), mat):
+        x, y, z = x - self.box.minx, y - self.box.miny, z - self.box.minz
+        if 0 <= x < self.box.width and 0 <= y < self.box.height and 0 <= z < self.box.length:
+            self.Blocks[x, z, y], self.Data[x, z, y] = _materialIDs(mat)
+            self.written[x, z, y] = True
+
+    def setMaterialsAt(self, xs, ys, zs, mat):
+        xs, ys, zs = np.asarray(xs) - self.box.minx, np.asarray(ys) - self.box.miny, np.asarray(zs) - self.box.minz
+        inside = (0 <= xs) & (xs < self.box.width) & (0 <= ys) & (ys < self.box.height) & (0 <= zs) & (zs < self.box.length)
+        IDs, data = np.empty(xs.shape, dtype=int), np.empty(xs.shape, dtype=int)
+        IDs[:], data[:] = _materialIDs(mat)
+        index = xs[inside], zs[inside], ys[inside]
+        self.Blocks[index] = IDs[inside]
+        self.Data[index] = data[inside]
+        self.written[index] = True
+
+    def fill(self, box, mat):
+        slices = self._slices(box)
+        self.Blocks[slices], self.Data[slices] = _materialIDs(mat)
+        self.written[slices] = True
+
+    def paste(self, voxels):
+        "Copy the written blocks of another VoxelBlock over this one's, where the two overlap"
+        target, source = self._slices(voxels.box), voxels._slices(self.box)
+        written = voxels.written[source]
+        self.Blocks[target][written] = voxels.Blocks[source][written]
+        self.Data[target][written] = voxels.Data[source][written]
+        self.written[target] |= written
@@ -0,0 +1,104 @@
+'''
+Streaming mode for very large selections. The selection is cut into tiles of a fixed size, separated by
+straight seam roads. Tiles are generated one after the other: analysed, split into plots, built and flushed;
+then their chunks are released, so memory use depends on the tile size instead of the selection size.
+'''
+import random
+from pymclevel import BoundingBox
+
+from myglobals import *
+import boxutils as bu
+from buildsite import Site, Plot, splitIntoPlots
+from construction import bidAndBuild
+import metrics
+
+# as wide as the widest roads between plots
+SEAM_WIDTH = 5
+
+def tileRanges(start, stop, tileSize):
+    '''
+    Split [start, stop) into tiles with a seam after each but the last one.
+    Returns (tileStart, tileStop, seamStop) triples; a remainder too small for a tile of its own is added to the last tile.
+    '''
+    ranges = []
+    while start < stop:
+        tileStop = start + tileSize
+        if stop - tileStop - SEAM_WIDTH < tileSize // 4:
+            tileStop = stop
+        seamStop = min(tileStop + SEAM_WIDTH, stop)
+        ranges.append( (start, tileStop, seamStop) )
+        start = seamStop
+    return ranges
+
+class Tile(object):
+    '''
+    Part of the selection that is generated in one go. The tile builds the seams after it along x and z,
+    so its site covers the tile and those seams; the seams before it belong to the neighbouring tiles.
+    '''
+
+    def __init__(self, (x0, x1, xSeam), (z0, z1, zSeam), selection):
+        y0, height = selection.miny, selection.height
+        self.box = BoundingBox( (x0, y0, z0), (x1 - x0, height, z1 - z0) )
+        self.bounds = BoundingBox( (x0, y0, z0), (xSeam - x0, height, zSeam - z0) )
+        self.seams = []
+        if xSeam > x1: # the crossing of two seams belongs to the one along z
+            self.seams.append( BoundingBox( (x1, y0, z0), (xSeam - x1, height, zSeam - z0) ) )
+        if zSeam > z1:
+            self.seams.append( BoundingBox( (x0, y0, z1), (x1 - x0, height, zSeam - z1) ) )
+        self.foreignSeams = []
+
+def layoutTiles(selection, tileSize):
+    "The tiles of the selection, in the order they are generated in"
+    xRanges = tileRanges(selection.minx, selection.maxx, tileSize)
+    zRanges = tileRanges(selection.minz, selection.maxz, tileSize)
+    grid = [ [ Tile(xRange, zRange, selection) for xRange in xRanges ] for zRange in zRanges ]
+    # the seams before a tile are built by its neighbours, but its plots still face them
+    for row, tiles in enumerate(grid):
+        for column, tile in enumerate(tiles):
+            if column > 0:
+                tile.foreignSeams.append( tiles[column-1].seams[0] )
+            if row > 0:
+                tile.foreignSeams.append( grid[row-1][column].seams[-1] )
+    return [ tile for tiles in grid for tile in tiles ]
+
+def seamPlots(site, seams):
+    plots = [ Plot(site, seam) for seam in seams ]
+    for plot in plots:
+        plot.tags.append('road')
+    return plots
+
+def tileRegistrar(tile):
+    "Split the tile into plots, with its seams as extra road plots"
+    def register(site):
+        return splitIntoPlots(site, tile.box) + seamPlots(site, tile.seams)
+    return register
+
+def addForeignNeighbours(plots, foreignPlots):
+    "Make plots that are built elsewhere neighbours of the plots touching them, without adding them to the site"
+    for i, j in bu.touchingPairs(plots + foreignPlots):
+        if i < len(plots) <= j:
+            plots[i].neighbours.append( foreignPlots[j - len(plots)] )
+
+def releaseChunks(level):
+    "Drop everything held for the chunks of finished tiles; written blocks must have been flushed"
+    if hasattr(level, 'commit'): # staging level
+        level.commit()
+        level.release()
+    level.chunkCache.clear()
+
+########################################################################
+
+def buildTiled(level, selection, tileSize, processes=1, cache=None, **siteOptions):
+    "Generate a settlement on the selection tile by tile, see the module docs"
+    # all tiles share one season, and plots are laid out relative to the whole selection
+    siteOptions.setdefault( 'season', random.choice(['spring', 'summer', 'autumn', 'winter']) )
+    tiles = layoutTiles(selection, tileSize)
+    for tile in tiles:
+        with metrics.stage('tile'):
+            site = Site(level, tile.bounds, registrar=tileRegistrar(tile), processes=processes, cache=cache,
+                        layoutBounds=selection, **siteOptions)
+            addForeignNeighbours( site.plots, seamPlots(site, tile.foreignSeams) )
+            bidAndBuild(site, processes)
+            site.detach()
+            releaseChunks(level)
+        metrics.count('tiles')